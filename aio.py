@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import asyncio
+
+from scheduler import Scheduler
+from recipe import Recipe, Script, Steps
+from target import Rule
+from wert import Context
+
+async def run_recipe(recipe: Recipe, ctx: Context):
+    """
+    Runs the given recipe without blocking the event loop: scripts run as
+    asyncio subprocesses, other callables in the loop's default executor.
+    """
+    if isinstance(recipe, Script):
+        cmd, kwargs = recipe.prepare(ctx)
+
+        start = recipe.started(cmd)
+        recipe.finished( cmd, start, await recipe.env.execute_async(cmd, **kwargs) )
+    elif isinstance(recipe, Steps):
+        for step in recipe.steps:
+            await run_recipe(step, ctx)
+    else:
+        await asyncio.get_running_loop().run_in_executor(None, recipe, ctx)
+
+class AsyncScheduler(Scheduler):
+    """
+    A Scheduler that runs recipes as asyncio tasks. A single thread can drive
+    many concurrent scripts this way, and mach can be used from within an
+    application that already runs an event loop.
+    """
+
+    async def run_async(self, root: Rule):
+        self._load(root)
+
+        while self._busy():
+            for rule, status in self._schedule():
+                task = asyncio.create_task( self.macher.execute_async(rule, status.context, status.key) )
+                self.running[task] = ( rule, status )
+
+            if not self.running:
+                continue
+
+            done, _ = await asyncio.wait(self.running, timeout=self._poll_interval(), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                self._completed(task, task.exception())
+
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,354 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+from concurrent.futures import Future
+from typing import Any, Mapping, Sequence
+
+from remote import RemoteCache
+
+_digest_pattern = re.compile(r'[0-9a-f]{64}')
+
+# The cache is walked to check its size at least this often, as other
+# processes sharing it may have added files we didn't count.
+_WALK_EVERY = 100
+
+# From linux/fs.h: clone a file's extents instead of copying its content.
+_FICLONE = 0x40049409
+
+def cache_key(command: str, inputs: Mapping[str, str], envars: Mapping[str, str], outputs: Sequence[str]) -> str:
+    """A key for what a recipe does: its command, the content of its inputs, and its environment"""
+    data = {
+        "command": command,
+        "inputs": dict(inputs),
+        "envars": dict(envars),
+        "outputs": list(outputs),
+    }
+
+    text = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _clone(src: str, dst: str):
+    """Copies src to dst, sharing the data blocks if the file system supports it"""
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+            return
+        except OSError:
+            pass
+
+        shutil.copyfileobj(s, d, 1 << 20)
+
+def _valid_record(outputs: Any, names: Sequence[str] | None = None) -> bool:
+    """
+    Checks an action record, which may come from a remote cache anyone could
+    write to: it must list objects by digest, and, if names are given, the
+    outputs must be exactly those.
+    """
+    if not isinstance(outputs, dict):
+        return False
+
+    if names is not None and set(outputs) != set(names):
+        return False
+
+    return all(
+        isinstance(o, dict) and isinstance(o.get("digest"), str) and _digest_pattern.fullmatch(o["digest"])
+        and isinstance(o.get("mode"), int)
+        for o in outputs.values()
+    )
+
+class ArtifactCache:
+    """
+    A local cache of the files made by recipes, so switching back and forth
+    between branches doesn't mean making the same files again and again.
+
+    Files are stored by the hash of their content in objects/. For each key,
+    an action record in actions/ lists the outputs the recipe made, and the
+    objects that hold them. Outputs are restored as reflinks where the file
+    system supports it, or as copies. They are never hard linked: recipes
+    that modify their output in place would corrupt the cache.
+
+    Records and objects from the remote cache are not trusted: records are
+    checked for sane digests and must list exactly the outputs of the rule
+    being restored, and objects are checked against their digest.
+
+    Both objects and actions are touched when used. trim() removes the ones
+    that were used least recently until the cache fits its size limit. The
+    total size is kept in a file, so the cache only has to be walked when
+    it is over the limit, or once in a while to correct the total.
+
+    With a remote cache, entries missing locally are downloaded from it,
+    and new entries are uploaded to it in the background. prefetch() starts
+    a download early, so it overlaps with other work until restore() needs it.
+    """
+
+    path: str
+    limit: int
+    remote: RemoteCache | None
+    total: int | None
+    builds: int
+
+    def __init__(self, path: str, limit: int, remote: RemoteCache | None = None):
+        self.path = path
+        self.limit = limit
+        self.remote = remote
+
+        self.fetching: dict[str, Future] = {}
+        self.lock = threading.Lock()
+
+        self.total = None
+        self.builds = 0
+        self._load_size()
+
+    def _size_path(self) -> str:
+        return os.path.join(self.path, "size")
+
+    def _load_size(self):
+        try:
+            with open(self._size_path(), "r", encoding="utf-8") as f:
+                data = json.load(f)
+
+            self.total = int(data["total"])
+            self.builds = int(data["builds"])
+        except (OSError, ValueError, KeyError, TypeError):
+            # We'll have to count.
+            self.total = None
+            self.builds = 0
+
+    def _save_size(self):
+        def write(tmp: str):
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({ "total": self.total, "builds": self.builds }, f)
+
+        self._write(self._size_path(), write)
+
+    def _added(self, path: str):
+        """Counts the given file, which was just added to the cache"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+
+        with self.lock:
+            if self.total is not None:
+                self.total += size
+
+    def _action_path(self, key: str) -> str:
+        return os.path.join(self.path, "actions", key[:2], key)
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.path, "objects", digest[:2], digest)
+
+    def _write(self, path: str, write: Any):
+        """Writes a file atomically, using the given function to fill it"""
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        os.close(fd)
+
+        try:
+            write(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _download(self, kind: str, name: str, path: str) -> bool:
+        assert self.remote is not None
+        remote = self.remote
+
+        def get(tmp: str):
+            if not remote.get(kind, name, tmp):
+                raise FileNotFoundError(name)
+
+            if kind == "cas":
+                with open(tmp, "rb") as f:
+                    if hashlib.file_digest(f, "sha256").hexdigest() != name:
+                        raise ValueError(f"Corrupt object {name}")
+
+        try:
+            self._write(path, get)
+            return True
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def _fetch(self, key: str) -> bool:
+        """Downloads the entry for the given key from the remote cache, unless we have it"""
+        action = self._action_path(key)
+        if os.path.isfile(action):
+            return True
+
+        # Get the record first, but only put it in place once we have all objects.
+        record = action + ".remote"
+        if not self._download("ac", key, record):
+            return False
+
+        try:
+            with open(record, "r", encoding="utf-8") as f:
+                outputs = json.load(f)
+
+            if not _valid_record(outputs):
+                return False
+
+            for output in outputs.values():
+                digest = output["digest"]
+                obj = self._object_path(digest)
+
+                if not os.path.isfile(obj):
+                    if not self._download("cas", digest, obj):
+                        return False
+
+                    self._added(obj)
+
+            os.replace(record, action)
+            self._added(action)
+            return True
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        finally:
+            if os.path.exists(record):
+                os.unlink(record)
+
+    def prefetch(self, key: str):
+        """Starts downloading the entry for the given key from the remote cache"""
+        if self.remote is None or os.path.isfile(self._action_path(key)):
+            return
+
+        with self.lock:
+            if key not in self.fetching:
+                self.fetching[key] = self.remote.submit(self._fetch, key)
+
+    def _upload(self, key: str, record: dict[str, Any]):
+        assert self.remote is not None
+
+        # Objects first, so the remote never has a record without its objects.
+        for output in record.values():
+            digest = output["digest"]
+
+            if not self.remote.has("cas", digest) and not self.remote.put("cas", digest, self._object_path(digest)):
+                return
+
+        self.remote.put("ac", key, self._action_path(key))
+
+    def flush(self):
+        """Waits for uploads to the remote cache"""
+        if self.remote is not None:
+            self.remote.drain()
+
+    def restore(self, key: str, names: Sequence[str]) -> bool:
+        """
+        Restores the outputs recorded for the given key, which must be the files
+        with the given names. Returns False if there are none.
+        """
+        action = self._action_path(key)
+
+        if self.remote is not None:
+            with self.lock:
+                future = self.fetching.pop(key, None)
+
+            if future is not None:
+                future.result()
+            else:
+                self._fetch(key)
+
+        try:
+            with open(action, "r", encoding="utf-8") as f:
+                outputs = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if not _valid_record(outputs, names):
+            return False
+
+        objects = [ self._object_path(o["digest"]) for o in outputs.values() ]
+        if not all( os.path.isfile(obj) for obj in objects ):
+            # Some objects were evicted, the record is useless now.
+            try:
+                os.unlink(action)
+            except FileNotFoundError:
+                pass
+
+            return False
+
+        for ( name, output ), obj in zip(outputs.items(), objects):
+            self._write(name, lambda tmp: _clone(obj, tmp))
+            os.chmod(name, output["mode"] & 0o777)
+            os.utime(obj)
+
+        os.utime(action)
+        return True
+
+    def store(self, key: str, outputs: Sequence[str]):
+        """Stores the given files as the outputs for the given key"""
+        record = {}
+
+        for name in outputs:
+            with open(name, "rb") as f:
+                digest = hashlib.file_digest(f, "sha256").hexdigest()
+
+            obj = self._object_path(digest)
+            if os.path.isfile(obj):
+                os.utime(obj)
+            else:
+                self._write(obj, lambda tmp: _clone(name, tmp))
+                self._added(obj)
+
+            record[name] = { "digest": digest, "mode": os.stat(name).st_mode & 0o777 }
+
+        def write(tmp: str):
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(record, f)
+
+        self._write(self._action_path(key), write)
+        self._added(self._action_path(key))
+
+        if self.remote is not None:
+            self.remote.submit(self._upload, key, record)
+
+    def trim(self):
+        """Removes the least recently used entries until the cache fits its size limit"""
+        self.builds += 1
+
+        if self.total is not None and self.total <= self.limit and self.builds < _WALK_EVERY:
+            self._save_size()
+            return
+
+        entries = []
+        total = 0
+        size_path = self._size_path()
+
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(root, name)
+                if path == size_path:
+                    continue
+
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                entries.append( ( st.st_mtime_ns, st.st_size, path ) )
+                total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.limit:
+                break
+
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+            total -= size
+
+        self.total = total
+        self.builds = 0
+        self._save_size()
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+
+from typing import Any
+
+from depfile import parse_depfile
+
+Record = dict[str, Any]
+
+_VERSION = 1
+
+class BuildDb:
+    """
+    Persistent record of how each file target was last made: the command
+    that made it, and the signatures of the inputs it was made from.
+    This lets us rebuild a target when its command changes, not only when
+    its inputs get newer. We also remember how long each rule took to make,
+    so the scheduler can start long chains early. Dependencies read from
+    depfiles are kept too, so they are only parsed again after a depfile
+    changed.
+
+    The database is a JSON file. It is loaded when opened, and written
+    back by save() if anything changed. A BuildDb without a path lives
+    in memory only.
+    """
+
+    path: str | None
+    targets: dict[str, Record]
+    hashes: dict[str, list]
+    durations: dict[str, float]
+    deps: dict[str, list]
+    dirty: bool
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self.targets = {}
+        self.hashes = {}
+        self.durations = {}
+        self.deps = {}
+        self.dirty = False
+
+        if path is not None:
+            self.load()
+
+    def load(self):
+        assert self.path is not None
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            # A corrupt database just means we have to rebuild things.
+            return
+
+        if data.get("version") != _VERSION:
+            return
+
+        self.targets = data.get("targets", {})
+        self.hashes = data.get("hashes", {})
+        self.durations = data.get("durations", {})
+        self.deps = data.get("deps", {})
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        data = {
+            "version": _VERSION,
+            "targets": self.targets,
+            "hashes": self.hashes,
+            "durations": self.durations,
+            "deps": self.deps,
+        }
+
+        # Write to a temporary file first, so we never leave a half written database.
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def get(self, name: str) -> Record | None:
+        return self.targets.get(name)
+
+    def record(self, name: str, command: str | None, inputs: dict[str, str]):
+        self.targets[name] = {
+            "command": command,
+            "inputs": inputs,
+        }
+        self.dirty = True
+
+    def duration(self, name: str) -> float | None:
+        """How many seconds it took to make the given rule last time, if we know"""
+        return self.durations.get(name)
+
+    def record_duration(self, name: str, seconds: float):
+        self.durations[name] = round(seconds, 4)
+        self.dirty = True
+
+    def digest(self, path: str, st: os.stat_result) -> str:
+        """
+        Returns a hash of the file's content. Hashes are remembered along with
+        the file's inode, size and modification time, so a file is only read
+        again after it changed.
+        """
+        key = [ st.st_ino, st.st_size, st.st_mtime_ns ]
+        known = self.hashes.get(path)
+
+        if known is not None and known[:3] == key:
+            return known[3]
+
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+
+        self.hashes[path] = key + [ digest ]
+        self.dirty = True
+        return digest
+
+    def dependencies(self, path: str, st: os.stat_result) -> list[str]:
+        """
+        Returns the prerequisites listed in the given depfile. Like hashes,
+        they are remembered along with the file's inode, size and modification
+        time, so the file is only parsed again after it changed.
+        """
+        key = [ st.st_ino, st.st_size, st.st_mtime_ns ]
+        known = self.deps.get(path)
+
+        if known is not None and known[:3] == key:
+            return known[3]
+
+        with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+            deps = parse_depfile(f.read())
+
+        self.deps[path] = key + [ deps ]
+        self.dirty = True
+        return deps
@@ -0,0 +1,68 @@
+def parse_depfile(text: str) -> list[str]:
+    """
+    Returns the prerequisites listed in a dependency file in Makefile syntax,
+    as written by compilers with -MD or -MMD:
+
+        foo.o: foo.c foo.h \\
+          bar.h
+        foo.h:
+
+    Prerequisites of all rules in the file are returned, in order and each
+    only once. Backslash-escaped spaces and $$ are unescaped, comments and
+    the targets themselves are skipped.
+    """
+    deps: list[str] = []
+    seen: set[str] = set()
+
+    text = text.replace("\\\r\n", " ").replace("\\\n", " ")
+
+    for line in text.splitlines():
+        for dep in _prerequisites(line):
+            if dep not in seen:
+                seen.add(dep)
+                deps.append(dep)
+
+    return deps
+
+def _prerequisites(line: str) -> list[str]:
+    words: list[str] = []
+    word: list[str] = []
+    after_colon = False
+
+    def flush():
+        if word:
+            words.append("".join(word))
+            word.clear()
+
+    i = 0
+    while i < len(line):
+        c = line[i]
+        following = line[i+1:i+2]
+
+        if c == "\\" and following in (" ", "\t", "#"):
+            word.append(following)
+            i += 2
+            continue
+
+        if c == "$" and following == "$":
+            word.append("$")
+            i += 2
+            continue
+
+        if c == "#":
+            break
+
+        if c in " \t":
+            flush()
+        elif c == ":" and not after_colon and following in ("", " ", "\t"):
+            # A colon inside a word, as in C:/foo.h, doesn't end the targets.
+            flush()
+            words.clear()
+            after_colon = True
+        else:
+            word.append(c)
+
+        i += 1
+
+    flush()
+    return words if after_colon else []
@@ -0,0 +1,153 @@
+import json
+import os
+import re
+import time
+
+from fnmatch import fnmatchcase
+
+_VERSION = 1
+
+_magic_pattern = re.compile(r'[*?[]')
+
+# A directory modified this recently may change again within the same mtime tick.
+_SETTLE_NS = 1_000_000_000
+
+class DirIndex:
+    """
+    Listings of directories, for expanding glob patterns without walking the
+    whole tree on every build. Each listing is kept along with the directory's
+    modification time, which changes whenever an entry is added, removed or
+    renamed, so a directory is only listed again after that happened.
+
+    The index is a JSON file. It is loaded when opened, and written back by
+    save() if anything changed. A DirIndex without a path lives in memory only.
+    """
+
+    path: str | None
+    dirs: dict[str, list]
+    dirty: bool
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self.dirs = {}
+        self.dirty = False
+
+        if path is not None:
+            self.load()
+
+    def load(self):
+        assert self.path is not None
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get("version") == _VERSION:
+            self.dirs = data.get("dirs", {})
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({ "version": _VERSION, "dirs": self.dirs }, f, separators=(",", ":"))
+
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def listing(self, directory: str) -> tuple[list[str], list[str]]:
+        """Returns the names of the files and of the subdirectories in the given directory"""
+        try:
+            st = os.stat(directory)
+        except OSError:
+            return [], []
+
+        known = self.dirs.get(directory)
+        if known is not None and known[0] == st.st_mtime_ns:
+            return known[1], known[2]
+
+        files: list[str] = []
+        dirs: list[str] = []
+
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    # Symlinks to directories are not followed, so ** can't loop.
+                    ( dirs if entry.is_dir(follow_symlinks=False) else files ).append(entry.name)
+        except OSError:
+            return [], []
+
+        files.sort()
+        dirs.sort()
+
+        if time.time_ns() - st.st_mtime_ns > _SETTLE_NS:
+            self.dirs[directory] = [ st.st_mtime_ns, files, dirs ]
+            self.dirty = True
+
+        return files, dirs
+
+    def glob(self, pattern: str, dirs: set[str] | None = None) -> list[str]:
+        """
+        Returns the files matching the given pattern, sorted. The pattern uses
+        shell wildcards, and ** for any number of directories. As with the glob
+        module, names starting with a dot only match wildcards starting with one.
+        The directories that were looked at are added to dirs, if given.
+        """
+        parts = pattern.split("/")
+        if parts[-1] == "**":
+            parts.append("*")
+
+        fixed = 0
+        while fixed < len(parts) and not _magic_pattern.search(parts[fixed]):
+            fixed += 1
+
+        base = "/".join(parts[:fixed])
+        if fixed == len(parts):
+            # No wildcards at all.
+            if dirs is not None:
+                dirs.add(os.path.dirname(pattern) or ".")
+
+            return [ pattern ] if os.path.isfile(pattern) else []
+
+        if base == "" and pattern.startswith("/"):
+            base = "/"
+
+        found: list[str] = []
+        self._match(base, parts[fixed:], found, dirs)
+        return sorted(set(found))
+
+    def _match(self, directory: str, parts: list[str], found: list[str], visited: set[str] | None):
+        part, rest = parts[0], parts[1:]
+        files, dirs = self.listing(directory or ".")
+
+        if visited is not None:
+            visited.add(directory or ".")
+
+        if part == "**":
+            self._match(directory, rest, found, visited)
+
+            for name in dirs:
+                if not name.startswith("."):
+                    self._match(os.path.join(directory, name), parts, found, visited)
+
+            return
+
+        for name in ( dirs if rest else files ):
+            if name.startswith(".") and not part.startswith("."):
+                continue
+
+            if not fnmatchcase(name, part):
+                continue
+
+            path = os.path.join(directory, name)
+            if rest:
+                self._match(path, rest, found, visited)
+            else:
+                found.append(path)
@@ -1,3 +1,10 @@
+import asyncio
+import atexit
+import codecs
+import os
+import re
+import selectors
+import shlex
 import subprocess
 import threading
 import sys
@@ -9,6 +16,8 @@ StdOutHandler: TypeAlias = Callable[[str], str]
 
 EOF = None
 
+_shell_name_pattern = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
 class OutputHandler(Protocol):
     def handle(self, line: str | None): ...
 
@@ -42,50 +51,478 @@ class OutputMode(Enum):
     def __call__(self, *args, **kwargs):
         return self.value(*args, **kwargs)  # pyright: ignore[reportAbstractUsage]
 
-def _shovel( pipe: IO[str], handler: OutputHandler, encoding: str = 'utf-8' ):
-    for line in iter(pipe.readline, ''):
-        handler.handle(line)
+class _LineSplitter:
+    """Decodes data read from a pipe chunk by chunk, and splits it into lines"""
+
+    partial: str
+
+    def __init__(self, encoding: str):
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self.partial = ""
+
+    def feed(self, data: bytes) -> list[str]:
+        """Returns the lines completed by the given data. Empty data means EOF."""
+        text = self.partial + self.decoder.decode(data, final = not data)
+        *lines, self.partial = text.split("\n")
+        lines = [ line + "\n" for line in lines ]
+
+        if not data and self.partial:
+            lines.append(self.partial)
+            self.partial = ""
+
+        return lines
+
+class _Stream:
+    """A pipe read by the multiplexer"""
+
+    pipe: IO[bytes]
+    on_line: Callable[[str], None]
+    on_eof: Callable[[], None]
+
+    def __init__(self, pipe: IO[bytes], on_line: Callable[[str], None], on_eof: Callable[[], None], encoding: str):
+        self.pipe = pipe
+        self.on_line = on_line
+        self.on_eof = on_eof
+        self.splitter = _LineSplitter(encoding)
+
+    def feed(self, data: bytes):
+        for line in self.splitter.feed(data):
+            self.on_line(line)
+
+        if not data:
+            self.close()
+
+    def close(self):
+        """Closes the pipe and reports the end of the stream, unless that already happened"""
+        if self.pipe.closed:
+            return
+
+        self.pipe.close()
+        self.on_eof()
+
+class Multiplexer:
+    """
+    Reads the output of all running commands on a single thread, using a
+    selector to wait for any of the pipes to become readable. Data is read in
+    large chunks and passed on line by line. The thread ends when there is
+    nothing left to read, and is started again for the next command.
+    """
+
+    _BUFFER_SIZE = 65536
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.pending: list[_Stream] = []
+        self.thread: threading.Thread | None = None
+
+        # Writing to this pipe wakes up the loop, so it registers new streams.
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+
+    def add(self, pipe: IO[bytes], on_line: Callable[[str], None], on_eof: Callable[[], None], encoding: str):
+        """
+        Starts reading from the given pipe. on_line is called for each line read,
+        on_eof when the pipe is closed. Both are called on the multiplexer thread.
+        """
+        os.set_blocking(pipe.fileno(), False)
+
+        with self.lock:
+            self.pending.append( _Stream(pipe, on_line, on_eof, encoding) )
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+
+        os.write(self.wake_w, b"x")
+
+    def _loop(self):
+        try:
+            while True:
+                with self.lock:
+                    if not self.pending and len(self.selector.get_map()) == 1:
+                        # Nothing left to read, don't keep a thread around, e.g. for forking.
+                        self.thread = None
+                        return
+
+                for key, _ in self.selector.select():
+                    if key.fd == self.wake_r:
+                        self._register()
+                        continue
+
+                    self._read(key)
+        finally:
+            # Let the next command start a new thread if this one died.
+            with self.lock:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+
+    def _read(self, key: selectors.SelectorKey):
+        stream: _Stream = key.data
+        try:
+            data = os.read(key.fd, self._BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self.selector.unregister(key.fd)
+
+        try:
+            stream.feed(data)
+        except Exception:
+            # A failing handler, e.g. one writing to a closed stdout, only ends its own stream.
+            if data:
+                self.selector.unregister(key.fd)
+
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def _register(self):
+        try:
+            while os.read(self.wake_r, 1024):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+
+        for stream in pending:
+            self.selector.register(stream.pipe.fileno(), selectors.EVENT_READ, stream)
+
+_multiplexer = Multiplexer()
+
+class _Job:
+    token: str
+    stdout: OutputHandler
+    stderr: OutputHandler
+    code: int | None
+    pending: int
+    finished: threading.Event
+
+    def __init__(self, token: str, output: OutputMode):
+        self.token = token
+        self.stdout = output()
+        self.stderr = output()
+        self.code = None
+        self.pending = 2
+        self.finished = threading.Event()
+
+class _ShellWorker:
+    """
+    A long-lived shell process. Each job is sent as a subshell command over
+    stdin, followed by a command that prints a sentinel with the job's exit
+    code to stdout, and the sentinel alone to stderr. Output up to the
+    sentinels belongs to the job.
+    """
+
+    process: subprocess.Popen
+    job: _Job | None
+    count: int
+    alive: bool
+
+    def __init__(self, shell: str, encoding: str, pass_fds: tuple[int, ...] = ()):
+        self.process = subprocess.Popen(
+            shell,
+            shell = False,
+            stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE,
+            # Like Popen(env=...) in the one-shot path, jobs only see the variables passed to them.
+            env = {},
+            pass_fds = pass_fds )
+
+        self.encoding = encoding
+        self.job = None
+        self.count = 0
+        self.alive = True
+        self.lock = threading.Lock()
+
+        assert(self.process.stdout)
+        assert(self.process.stderr)
+
+        for pipe, is_stdout in ( (self.process.stdout, True), (self.process.stderr, False) ):
+            _multiplexer.add(
+                pipe,
+                lambda line, is_stdout=is_stdout: self._on_line(line, is_stdout),
+                lambda is_stdout=is_stdout: self._on_eof(is_stdout),
+                encoding )
+
+    def _on_line(self, line: str, is_stdout: bool):
+        job = self.job
+        if job is None:
+            return
+
+        handler = job.stdout if is_stdout else job.stderr
+        idx = line.find(job.token)
+
+        if idx < 0:
+            handler.handle(line)
+            return
+
+        # The output of the job may not have ended with a newline.
+        if idx > 0:
+            handler.handle(line[:idx])
+
+        if is_stdout:
+            job.code = int(line[idx+len(job.token):].strip())
 
-    handler.handle(EOF)
+        self._done(job, handler)
 
-def _start_shoveling(pipe: IO[str], handler: OutputHandler, **kwargs) -> threading.Thread:
-    thread = threading.Thread(target=_shovel, args = [pipe, handler], kwargs = kwargs)
-    thread.start()
-    return thread
+    def _on_eof(self, is_stdout: bool):
+        # The shell died, fail the current job if there is one.
+        self.alive = False
+        job = self.job
+        if job is not None:
+            self._done(job, job.stdout if is_stdout else job.stderr)
+
+    def _done(self, job: _Job, handler: OutputHandler):
+        try:
+            handler.handle(EOF)
+        finally:
+            with self.lock:
+                job.pending -= 1
+                if job.pending == 0:
+                    job.finished.set()
+
+    def run(self, script: str, output: OutputMode, envars: dict[str, str], cwd: str | None) -> int:
+        self.count += 1
+        job = _Job(f"__mach_{os.getpid()}_{id(self)}_{self.count}__", output)
+
+        exports = "".join( f"export {k}={shlex.quote(v)}; " for k, v in envars.items() if _shell_name_pattern.fullmatch(k) )
+        # Like Popen(cwd=...), don't run the script anywhere else if the directory is missing.
+        chdir = f"cd {shlex.quote(cwd)} || exit 1; " if cwd else ""
+
+        command = (
+            f"( {chdir}{exports}eval {shlex.quote(script)}\n) </dev/null\n"
+            f"printf '%s %d\\n' {job.token} $?\n"
+            f"printf '%s\\n' {job.token} >&2\n"
+        )
+
+        self.job = job
+        try:
+            assert(self.process.stdin)
+            self.process.stdin.write(command.encode(self.encoding))
+            self.process.stdin.flush()
+        except OSError:
+            self.alive = False
+            self.job = None
+            raise
+
+        job.finished.wait()
+        self.job = None
+
+        if job.code is None:
+            # The script killed the shell, report it like the one-shot path would.
+            return self.process.wait()
+
+        return job.code
+
+    def close(self):
+        if self.process.stdin:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                # The shell is gone already.
+                pass
+
+        self.process.wait()
+
+class ShellPool:
+    """
+    A pool of long-lived shell processes for running scripts, to avoid
+    starting a new shell for every script. Each script still runs in its
+    own subshell, with its own working directory and environment.
+    """
+
+    shell: str
+    encoding: str
+    size: int
+    idle: list[_ShellWorker]
+    workers: list[_ShellWorker]
+
+    def __init__(self, size: int, shell: str, encoding: str, pass_fds: tuple[int, ...] = ()):
+        self.size = size
+        self.shell = shell
+        self.encoding = encoding
+        self.pass_fds = pass_fds
+        self.idle = []
+        self.workers = []
+        self.cond = threading.Condition()
+
+    def _acquire(self) -> _ShellWorker:
+        with self.cond:
+            while True:
+                if self.idle:
+                    return self.idle.pop()
+
+                if len(self.workers) < self.size:
+                    worker = _ShellWorker(self.shell, self.encoding, self.pass_fds)
+                    self.workers.append(worker)
+                    return worker
+
+                self.cond.wait()
+
+    def _release(self, worker: _ShellWorker):
+        with self.cond:
+            if worker.alive:
+                self.idle.append(worker)
+            else:
+                # Make room for a new worker.
+                self.workers.remove(worker)
+
+            self.cond.notify()
+
+        if not worker.alive:
+            worker.close()
+
+    def execute(self, script: str, output: OutputMode, envars: dict[str, str], cwd: str | None = None) -> int:
+        worker = self._acquire()
+        try:
+            return worker.run(script, output, envars, cwd)
+        finally:
+            self._release(worker)
+
+    def close(self):
+        with self.cond:
+            workers = self.workers
+            self.workers = []
+            self.idle = []
+
+        for worker in workers:
+            worker.close()
 
 class Environment:
     shell: str
     encoding: str
+    pool: ShellPool | None
+    pass_fds: tuple[int, ...]
 
     def __init__(self):
         self.shell = "/bin/sh"
         self.encoding = 'utf-8'
+        self.pool = None
+
+        # File descriptors to be inherited by all commands, e.g. for a jobserver.
+        self.pass_fds = ()
 
-    def execute(self, script: str, output: OutputMode = OutputMode.LINES, shell: str | None = None, encoding: str | None = None, envars = None ) -> int:
+    def use_pool(self, size: int):
+        """
+        Run scripts on a pool of up to size long-lived shells, instead of
+        starting a new shell for each script. A size of 0 disables the pool.
+        """
+        if self.pool is not None:
+            if self.pool.size == size and self.pool.pass_fds == self.pass_fds:
+                return
+
+            self.pool.close()
+            self.pool = None
+
+        if size > 0:
+            self.pool = ShellPool(size, self.shell, self.encoding, self.pass_fds)
+            atexit.register(self.pool.close)
+
+    def execute(self, script: str, output: OutputMode = OutputMode.LINES, shell: str | None = None, encoding: str | None = None, envars = None, cwd: str | None = None ) -> int:
         encoding = str(encoding or self.encoding)
 
+        pool = self.pool
+        if pool is not None and (shell or self.shell) == pool.shell and encoding == pool.encoding:
+            if envars is None:
+                envars = dict(os.environ)
+
+            return pool.execute(script, output, envars, cwd)
+
         p = subprocess.Popen(
             shell or self.shell,
             shell = False,
             stdin = subprocess.PIPE,
             stdout = subprocess.PIPE,
             stderr = subprocess.PIPE,
-            encoding = encoding,
-            env = envars )
+            env = envars,
+            cwd = cwd,
+            pass_fds = self.pass_fds )
 
         assert(p.stdin)
         assert(p.stdout)
         assert(p.stderr)
 
-        _start_shoveling(p.stdout, output(), encoding = encoding)
-        _start_shoveling(p.stderr, output(), encoding = encoding)
+        drained = threading.Semaphore(0)
+
+        for pipe in ( p.stdout, p.stderr ):
+            handler = output()
+
+            def on_eof(handler=handler):
+                try:
+                    handler.handle(EOF)
+                finally:
+                    drained.release()
 
-        p.stdin.write(script)
-        p.stdin.close()
+            _multiplexer.add(pipe, handler.handle, on_eof, encoding)
+
+        try:
+            p.stdin.write(script.encode(encoding))
+            p.stdin.close()
+        except BrokenPipeError:
+            # The shell exited without reading all of the script.
+            pass
 
         p.wait()
 
+        # Make sure all output was handled before we return.
+        drained.acquire()
+        drained.acquire()
+
         return p.returncode
 
+    async def execute_async(self, script: str, output: OutputMode = OutputMode.LINES, shell: str | None = None, encoding: str | None = None, envars = None, cwd: str | None = None ) -> int:
+        """Like execute, but runs the script as an asyncio subprocess"""
+        encoding = str(encoding or self.encoding)
+
+        p = await asyncio.create_subprocess_exec(
+            shell or self.shell,
+            stdin = asyncio.subprocess.PIPE,
+            stdout = asyncio.subprocess.PIPE,
+            stderr = asyncio.subprocess.PIPE,
+            env = envars,
+            cwd = cwd,
+            pass_fds = self.pass_fds )
+
+        assert(p.stdin)
+        assert(p.stdout)
+        assert(p.stderr)
+
+        async def pump(reader: asyncio.StreamReader, handler: OutputHandler):
+            splitter = _LineSplitter(encoding)
+
+            while True:
+                data = await reader.read(Multiplexer._BUFFER_SIZE)
+
+                for line in splitter.feed(data):
+                    handler.handle(line)
+
+                if not data:
+                    break
+
+            handler.handle(EOF)
+
+        pumps = asyncio.gather( pump(p.stdout, output()), pump(p.stderr, output()) )
+
+        try:
+            p.stdin.write(script.encode(encoding))
+            await p.stdin.drain()
+            p.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # The shell exited without reading all of the script.
+            pass
+
+        await pumps
+        return await p.wait()
+
     def print(self, s):
         print(s)
@@ -0,0 +1,52 @@
+from typing import Any
+
+class Listener:
+    """
+    Receives events about the progress of a build. Subclasses override the
+    methods for the events they care about. Recipes run on worker threads,
+    so events about them may arrive on any thread, and at the same time.
+    """
+
+    def build_started(self, rule: Any):
+        pass
+
+    def build_finished(self, rule: Any, error: BaseException | None):
+        pass
+
+    def rule_resolved(self, rule: Any):
+        """A rule was found to be needed for the build"""
+        pass
+
+    def rule_checked(self, rule: Any, reason: str | None):
+        """A rule was checked, reason tells why it is outdated, or is None if it isn't"""
+        pass
+
+    def recipe_started(self, rule: Any):
+        pass
+
+    def recipe_finished(self, rule: Any, seconds: float, code: int | None, error: BaseException | None):
+        """A recipe completed. The exit code is None for python recipes."""
+        pass
+
+    def script_started(self, cmd: str):
+        pass
+
+    def script_finished(self, cmd: str, seconds: float, code: int):
+        pass
+
+    def cache_hit(self, rule: Any):
+        pass
+
+    def cache_miss(self, rule: Any):
+        pass
+
+class Hooks(list[Listener]):
+    """
+    The listeners registered for a build. An empty Hooks is false, callers
+    check that before building event arguments, so events cost next to
+    nothing when nobody listens.
+    """
+
+    def emit(self, event: str, *args: Any):
+        for listener in self:
+            getattr(listener, event)(*args)
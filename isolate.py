@@ -0,0 +1,115 @@
+import multiprocessing
+import pickle
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable
+
+from recipe import Recipe
+from wert import Context
+
+class _Exports(dict):
+    """The base map of a recipe's context in a worker process, tracks exported keys"""
+
+    exported: set[str]
+
+    def __init__(self, values: dict[str, Any]):
+        super().__init__(values)
+        self.exported = set()
+
+    def __setitem__(self, key: str, value: Any):
+        super().__setitem__(key, value)
+        self.exported.add(key)
+
+# All isolated recipes, so forked workers can refer to them by index.
+_recipes: list['Isolated'] = []
+
+def _snapshot(ctx: Context) -> dict[str, Any]:
+    """The variables of the given context that can be sent to another process"""
+    snapshot = {}
+
+    for key, value in ctx.items():
+        try:
+            pickle.dumps(value)
+        except Exception:
+            continue
+
+        snapshot[key] = value
+
+    return snapshot
+
+def _run(recipe: 'int | Recipe', snapshot: dict[str, Any]) -> dict[str, Any]:
+    if isinstance(recipe, int):
+        # We were forked, so we know the recipe already.
+        recipe = _recipes[recipe].recipe
+
+    base = _Exports(snapshot)
+    recipe(Context(base))
+
+    return { key: base[key] for key in base.exported }
+
+class Workers:
+    """
+    The process pool for isolated recipes, owned by the Macher for the
+    duration of a build. Where possible, the worker processes are forked.
+    They then inherit all recipes, which need not be picklable. The pool
+    should be created before any other threads are started.
+    """
+
+    pool: ProcessPoolExecutor
+    forked: int
+
+    def __init__(self, workers: int):
+        if "fork" in multiprocessing.get_all_start_methods():
+            self.pool = ProcessPoolExecutor(workers, multiprocessing.get_context("fork"))
+            self.forked = len(_recipes)
+        else:
+            self.pool = ProcessPoolExecutor(workers)
+            self.forked = 0
+
+        # Start all workers now, while we know what state we are forking.
+        for f in [ self.pool.submit(int) for _ in range(workers) ]:
+            f.result()
+
+    def run(self, isolated: 'Isolated', ctx: Context) -> dict[str, Any]:
+        """Runs the given recipe in a worker, returns what it exported"""
+        recipe = isolated.index if isolated.index < self.forked else isolated.recipe
+        return self.pool.submit(_run, recipe, _snapshot(ctx)).result()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+class Isolated:
+    """
+    Wraps a python recipe so it runs in a separate worker process, to make
+    use of more than one core. The recipe gets a snapshot of the variables
+    in its context that can be pickled. Variables it exports are sent back
+    and exported in the calling process.
+
+    The workers are looked up when the recipe runs. Outside of a build,
+    the recipe gets a worker of its own.
+    """
+
+    recipe: Recipe
+    index: int
+    workers: Callable[[], Workers | None]
+
+    def __init__(self, recipe: Recipe, workers: Callable[[], Workers | None] = lambda: None):
+        self.recipe = recipe
+        self.workers = workers
+        self.index = len(_recipes)
+        _recipes.append(self)
+
+    def __call__(self, ctx: Context):
+        workers = self.workers()
+
+        if workers is not None:
+            exports = workers.run(self, ctx)
+        else:
+            workers = Workers(1)
+            try:
+                exports = workers.run(self, ctx)
+            finally:
+                workers.close()
+
+        for key, value in exports.items():
+            ctx.export(key, value)
@@ -0,0 +1,160 @@
+import os
+import re
+import threading
+
+from contextlib import contextmanager
+from typing import Iterator
+
+_auth_pattern = re.compile(r'--jobserver-(?:auth|fds)=(?:fifo:(\S+)|(\d+),(\d+))')
+_jobs_pattern = re.compile(r'(?:^|\s)-j(\d+)')
+
+class Jobserver:
+    """
+    Shares a limited number of job slots with other processes, using the GNU
+    make jobserver protocol: each token in a pipe represents a job slot. Every
+    process owns one implicit slot, and has to read a token from the pipe
+    before it can use another one. Tokens are written back when done.
+    """
+
+    read_fd: int
+    write_fd: int
+    limit: int | None
+    makeflags: str
+    owned: bool
+
+    def __init__(self, read_fd: int, write_fd: int, limit: int | None, makeflags: str, owned: bool = False):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.limit = limit
+        self.makeflags = makeflags
+        self.owned = owned
+
+        self.lock = threading.Lock()
+        self.implicit_free = True
+        self.poll_fd: int | None = None
+
+    @staticmethod
+    def from_makeflags(makeflags: str) -> 'Jobserver | None':
+        """
+        Connects to the jobserver advertised in the given MAKEFLAGS, as a client.
+        Returns None if there is none, or we can't reach it.
+        """
+        match = _auth_pattern.search(makeflags)
+        if match is None:
+            return None
+
+        jobs = _jobs_pattern.search(makeflags)
+        limit = int(jobs.group(1)) if jobs else None
+
+        fifo, read_fd, write_fd = match.groups()
+
+        if fifo:
+            try:
+                fd = os.open(fifo, os.O_RDWR)
+            except OSError:
+                return None
+
+            return Jobserver(fd, fd, limit, makeflags, True)
+
+        try:
+            # Make only passes the pipe to sub-makes it knows about, e.g. by a + prefix.
+            os.fstat(int(read_fd))
+            os.fstat(int(write_fd))
+        except OSError:
+            return None
+
+        return Jobserver(int(read_fd), int(write_fd), limit, makeflags)
+
+    @staticmethod
+    def create(jobs: int) -> 'Jobserver':
+        """Creates a jobserver for the given number of jobs, to share with child processes"""
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b"+" * (jobs - 1))
+
+        makeflags = f"-j{jobs} --jobserver-auth={read_fd},{write_fd}"
+        return Jobserver(read_fd, write_fd, jobs, makeflags, True)
+
+    @property
+    def pass_fds(self) -> tuple[int, ...]:
+        """The file descriptors child processes need to inherit"""
+        if self.read_fd == self.write_fd:
+            # A named pipe, children open it by name.
+            return ()
+
+        return ( self.read_fd, self.write_fd )
+
+    def acquire(self) -> bytes | None:
+        """Waits for a job slot. Returns the token to release, None for the implicit slot."""
+        with self.lock:
+            if self.implicit_free:
+                self.implicit_free = False
+                return None
+
+        while True:
+            try:
+                token = os.read(self.read_fd, 1)
+            except InterruptedError:
+                continue
+
+            if token:
+                return token
+
+            raise Exception("Jobserver pipe was closed")
+
+    def try_acquire(self) -> tuple[bool, bytes | None]:
+        """
+        Takes a job slot if one is free right away. Returns whether it got one,
+        and the token to release. The pipe is shared with other processes, so
+        rather than making it non-blocking, we read from a non-blocking file
+        descriptor of our own, opened through /proc. Where that isn't possible,
+        only the implicit slot can be had without waiting.
+        """
+        with self.lock:
+            if self.implicit_free:
+                self.implicit_free = False
+                return True, None
+
+            if self.poll_fd is None:
+                try:
+                    self.poll_fd = os.open(f"/proc/self/fd/{self.read_fd}", os.O_RDONLY | os.O_NONBLOCK)
+                except OSError:
+                    self.poll_fd = -1
+
+            fd = self.poll_fd
+
+        if fd < 0:
+            return False, None
+
+        try:
+            token = os.read(fd, 1)
+        except (BlockingIOError, InterruptedError):
+            return False, None
+
+        return ( True, token ) if token else ( False, None )
+
+    def release(self, token: bytes | None):
+        if token is None:
+            with self.lock:
+                self.implicit_free = True
+        else:
+            os.write(self.write_fd, token)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def close(self):
+        if self.poll_fd is not None and self.poll_fd >= 0:
+            os.close(self.poll_fd)
+            self.poll_fd = None
+
+        if not self.owned:
+            return
+
+        os.close(self.read_fd)
+        if self.write_fd != self.read_fd:
+            os.close(self.write_fd)
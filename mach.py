@@ -4,10 +4,12 @@ from typing import Callable, Sequence
 
 import help
 from macher import Macher, TargetLike, RecipeLike, Script
-from target import InputLike
+from target import InputLike, Glob
 from wert import VarValue, Context, expand_all, Function
 from env import OutputMode
 from recipe import Recipe
+from hooks import Listener
+from snapshot import GraphSnapshot, compile_cached, local_modules
 
 _disable_run = False
 
@@ -19,6 +21,11 @@ def run(*argv: str):
         argv = tuple(sys.argv)
 
     targets = macher.process_argv(argv)
+
+    if macher.options['watch']:
+        macher.watch([ macher.require_rule(tgt) for tgt in targets ])
+        return
+
     for tgt in targets:
         rule = macher.require_rule(tgt)
         macher.mach(rule)
@@ -37,10 +44,10 @@ def declare(name: str, default: VarValue, cli: str|bool = False):
     macher.declare(name, default, cli)
 
 def mach(
-    target: TargetLike, inputs: Sequence[InputLike] | None = None, recipe: RecipeLike | None = None, help: str | None = None
+    target: TargetLike | Sequence[TargetLike], inputs: Sequence[InputLike] | None = None, recipe: RecipeLike | None = None, help: str | None = None,
+    **options
 ):
-    # TODO: multi target
-    rule = macher.make_rule(target, inputs, recipe, help)
+    rule = macher.make_rule(target, inputs, recipe, help, **options)
     macher.add_rule(rule)
     return rule
 
@@ -62,14 +69,19 @@ def lazy(s: str) -> Function:
 def info(s: str) -> Recipe:
     return lambda context: print( expand_all(s, context) )
 
-def makes(tgt: TargetLike, *input: InputLike) -> Callable[[Recipe], Recipe]:
+def listen(listener: Listener) -> Listener:
+    """Registers a listener that is told about the progress of builds"""
+    macher.add_listener(listener)
+    return listener
+
+def makes(tgt: TargetLike | Sequence[TargetLike], *input: InputLike, **options) -> Callable[[Recipe], Recipe]:
     """
     Annotation that turns a  recipe function into a rule by
     associating it with a target
     """
 
     def decorator(fn: Recipe) -> Recipe:
-        mach(tgt, input, fn, fn.__doc__)
+        mach(tgt, input, fn, fn.__doc__, **options)
         return fn
 
     return decorator
@@ -78,8 +90,8 @@ mach( "help", (), help.recipe(macher), help.HELP )
 
 __all__ = [
     'declare', 'mach', 'run', 'script', 'lazy', 'info', 'mute', 'blind',
-    'makes',
-    'Context', 'OutputMode'
+    'makes', 'listen',
+    'Context', 'OutputMode', 'Listener', 'Glob'
 ]
 
 def main():
@@ -92,8 +104,7 @@ def main():
 
     global _disable_run
     _disable_run = True
-    with open(machfile, "rb") as src:
-        code = compile(src.read(), machfile, "exec")
+    code, digest = compile_cached(machfile, os.path.join(".mach", "Machfile.pyc"))
 
     # HACK: make sure the Machfile gets this module instance
     # when importing mach.
@@ -105,6 +116,9 @@ def main():
     globals = {}
     exec(code, globals, {})
 
+    # The resolved rule graph is cached, as long as the Machfile and what it imports don't change.
+    macher.machfile_key = GraphSnapshot.make_key([ digest, local_modules(".") ])
+
     _disable_run = False
     run(*argv)
 
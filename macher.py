@@ -1,23 +1,67 @@
 from __future__ import annotations
 
+import asyncio
+import os
 import re
-from collections.abc import Callable, Sequence
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Callable, Container, Sequence
 from typing import Mapping
 
-from target import Target, TargetLike, InputLike, Rule, File, TargetMatch, is_file_name
-from recipe import Recipe, RecipeLike, Script
+from target import Target, TargetLike, InputLike, Rule, File, Pattern, PatternIndex, TargetMatch, Glob, is_file_name
+from recipe import Recipe, RecipeLike, Script, Steps, signature, exit_code
 from env import Environment
 from wert import Context, VarValue
+from scheduler import Scheduler, Status
+from aio import AsyncScheduler, run_recipe
+from isolate import Isolated, Workers
+from statcache import StatCache
+from builddb import BuildDb
+from dirindex import DirIndex
+from jobserver import Jobserver
+from throttle import Throttle
+from tracing import Tracer
+from hooks import Hooks, Listener
+from artifacts import ArtifactCache, cache_key
+from remote import RemoteCache
+from snapshot import GraphSnapshot
+from watch import Watcher
 
 _VAR_NAME_PATTERN = re.compile( r'(\w\w+)' )
 _FLAG_PATTERN = re.compile( _VAR_NAME_PATTERN.pattern + r'=(.*)' )
 _OPTION_PATTERN = re.compile( r'--' + _VAR_NAME_PATTERN.pattern + r'(?:=(.*))?' )
-_DEFAULT_OPTIONS = {}
+_DEFAULT_OPTIONS = {
+    'jobs': '',
+    'scandirs': False,
+    'db': '.mach/db',
+    'shells': '0',
+    'engine': 'threads',
+    'maxload': '',
+    'minmem': '',
+    'trace': '',
+    'cache': '',
+    'cachesize': '1024',
+    'remote': '',
+    'watch': False,
+}
 
 class Macher:
     rules: list[Rule]
     rules_by_name: dict[str, Rule]
-
+    patterns: PatternIndex
+    pools: dict[str, int]
+
+    stats: StatCache
+    db: BuildDb
+    dirs: DirIndex
+    cache: ArtifactCache | None
+    snapshot: GraphSnapshot | None
+    machfile_key: str | None
+    jobserver: Jobserver | None
+    tracing: Tracer | None
+    workers: Workers | None
+    hooks: Hooks
     context: Context
     flags: dict[str, str|bool]
     options: dict[str, str|bool]
@@ -25,8 +69,22 @@ class Macher:
     def __init__(self):
         self.rules = []
         self.rules_by_name = {}
+        self.patterns = PatternIndex()
+        self.pools = {}
         self.context = Context()
         self.env = Environment()
+        self.stats = StatCache()
+        self.db = BuildDb()
+        self.dirs = DirIndex()
+        self.cache = None
+        self.snapshot = None
+        self.machfile_key = None
+        self.defined: set[str] = set()
+        self.plans: dict[Rule, list[Rule]] = {}
+        self.jobserver = None
+        self.tracing = None
+        self.workers = None
+        self.hooks = Hooks()
         self.flags = {}
         self.options = dict(_DEFAULT_OPTIONS)
 
@@ -37,44 +95,158 @@ class Macher:
         print(msg)
 
     def add_rule(self, rule: Rule):
-        name = rule.get_name()
-        if self.has_rule(name):
-            raise ValueError(f"There already is a rule for making {name}")
+        names = rule.get_names()
+        for name in names:
+            if self.has_rule(name):
+                raise ValueError(f"There already is a rule for making {name}")
 
         self.rules.append(rule)
-        self.rules_by_name[name] = rule
+        for name in names:
+            self.rules_by_name[name] = rule
+
+        # A new rule may take the place of a file in known plans.
+        self.plans = {}
+
+        if isinstance(rule.target, Pattern):
+            self.patterns.add(rule)
 
     def has_rule(self, name: str):
         return name in self.rules_by_name
 
+    def add_listener(self, listener: Listener):
+        """Registers a listener for build events, see hooks.Listener"""
+        self.hooks.append(listener)
+
+    def declare_pool(self, name: str, depth: int):
+        """Declares a pool of the given depth: no more than depth rules in the pool run at once"""
+        if depth < 1:
+            raise ValueError(f"Pool depth must be at least 1, got {depth} for pool {name}")
+
+        known = self.pools.get(name)
+        if known is not None and known != depth:
+            raise ValueError(f"Pool {name} was already declared with depth {known}")
+
+        self.pools[name] = depth
+
     def make_rule(
         self,
-        target: TargetLike,
+        target: TargetLike | Sequence[TargetLike],
         inputs: Sequence[InputLike] | None = None,
         recipe: RecipeLike | None = None,
-        help:   str | None = None
+        help:   str | None = None,
+        hashed: bool = False,
+        restat: bool = False,
+        isolate: str | None = None,
+        pool:   str | None = None,
+        depth:  int | None = None,
+        batch:  int | None = None,
+        depfile: str | None = None
     ):
-        return Rule(target, inputs or [], self._recipe(recipe), help)
+        recipe = self._recipe(recipe)
+
+        if isolate == "process":
+            if isinstance(recipe, (Script, Steps)):
+                raise ValueError("Only python recipes can be isolated in a process")
+
+            recipe = Isolated(recipe, lambda: self.workers)
+        elif isolate is not None:
+            raise ValueError(f"Unknown isolation mode {isolate}")
+
+        if depth is not None:
+            if pool is None:
+                raise ValueError("A pool depth needs a pool name")
+
+            self.declare_pool(pool, depth)
+
+        if batch is not None and batch < 1:
+            raise ValueError(f"Batch size must be at least 1, got {batch}")
+
+        rule = Rule(target, inputs or [], recipe, help, restat, pool, batch, depfile)
+
+        patterns = [ isinstance(t, Pattern) for t in rule.targets ]
+        if any(patterns) and not all(patterns):
+            raise ValueError(f"Targets of a rule must be all patterns or none: {rule.get_names()}")
+
+        if hashed:
+            for t in rule.targets:
+                if not isinstance(t, (File, Pattern)):
+                    raise ValueError(f"Only files can be hashed: {t}")
+
+                t.hashed = True
+
+        if depfile is not None and not all( isinstance(t, (File, Pattern)) for t in rule.targets ):
+            raise ValueError(f"Only rules making files can have a depfile: {rule.get_names()}")
+
+        return rule
 
     def find_rule(self, name: str) -> Rule | None:
-        # TODO: best match (for patterns), match non-patterns first
         # TODO: maybe: multi-match? (merge recipes and inputs)
-        for r in self.rules:
-            match = r.matches(name)
-            if match is not None:
-                cooked = self._cook_rule( r, match )
+        rule = self.rules_by_name.get(name)
+        if rule is not None:
+            return rule
+
+        found = self.patterns.match(name)
+        if found is None:
+            return None
+
+        r, match = found
+        cooked = self._cook_rule( r, match )
 
-                if cooked.get_name() != r.get_name() and not self.has_rule(cooked.get_name()):
-                    # remember the cooked rule, so we re-use it if we need it again.
-                    self.add_rule( cooked )
+        if cooked.get_name() != r.get_name() and not self.has_rule(cooked.get_name()):
+            # remember the cooked rule, so we re-use it if we need it again.
+            self.add_rule( cooked )
 
-                return cooked
+        return cooked
+
+    def _expand_inputs(self, inputs: Sequence[InputLike]) -> list[InputLike]:
+        """Replaces globs among the given inputs by the names of the files they match"""
+        if not any( isinstance(inp, Glob) for inp in inputs ):
+            return list(inputs)
+
+        expanded: list[InputLike] = []
+        for inp in inputs:
+            if isinstance(inp, Glob):
+                expanded.extend( inp.names(self.dirs.glob(inp.pattern)) )
+            else:
+                expanded.append(inp)
 
-        return None
+        return expanded
+
+    def _expand_again(self, rule: Rule) -> bool:
+        """
+        Expands the globs among the inputs of the given rule again, e.g. after
+        files were added. Returns whether that changed the inputs, in which
+        case the rule's inputs are resolved again when needed.
+        """
+        if rule.globbed is None or self._globs_match(rule.globbed, rule.inputs):
+            return False
+
+        rule.inputs = rule.globbed
+        self.plans.clear()
+        return True
+
+    def _glob_dirs(self, rule: Rule) -> set[str]:
+        """The directories listed for expanding the globs among the inputs of the given rule"""
+        dirs: set[str] = set()
+
+        for inp in rule.globbed or []:
+            if isinstance(inp, Glob):
+                self.dirs.glob(inp.pattern, dirs)
+
+        return dirs
 
     def _resolve_inputs(self, rule: Rule) -> Sequence[str]:
-        input_rules = [ self._input_rule(inp) for inp in rule.inputs ]
-        input_names = [ inp_rule.get_name() for inp_rule in input_rules ]
+        if any( isinstance(inp, Glob) for inp in rule.inputs ):
+            rule.globbed = list(rule.inputs)
+
+        inputs = self._expand_inputs(rule.inputs)
+        input_rules = [ self._input_rule(inp) for inp in inputs ]
+
+        # Keep the name of the target that was asked for, a rule may make several.
+        input_names = [
+            inp if isinstance(inp, str) else inp.name if isinstance(inp, Target) else inp_rule.get_name()
+            for inp, inp_rule in zip(inputs, input_rules)
+        ]
 
         rule.inputs = input_names # TODO: mark as resolved, so we don't resovle again??
         return input_names
@@ -91,6 +263,20 @@ class Macher:
 
         return target.get_cooked(name)
 
+    def _cook_inputs(self, rule: Rule, match: TargetMatch) -> list[InputLike]:
+        # The inputs of a pattern rule are templates, not names to resolve.
+        # Globs are kept as they are, they match the same files every time.
+        cooked_inputs: list[InputLike] = []
+        for inp in rule.inputs:
+            if isinstance(inp, Glob):
+                cooked_inputs.append(inp)
+            elif isinstance(inp, str):
+                cooked_inputs.append( match.cook_name(inp) )
+            else:
+                cooked_inputs.append( self._input_rule(inp).get_name() )
+
+        return cooked_inputs
+
     def _cook_rule(self, rule: Rule, match: TargetMatch) -> Rule:
         name = match.cook_name(rule.get_name())
 
@@ -100,15 +286,10 @@ class Macher:
         if name in self.rules_by_name:
             return self.rules_by_name[name]
 
-        input_names = self._resolve_inputs(rule)
-        cooked_inputs = [ match.cook_name(n) for n in input_names ]
+        rule = rule.cook( [ self._cook_target(t, match) for t in rule.targets ], self._cook_inputs(rule, match) )
 
-        rule = Rule(
-            self._cook_target( match.target, match),
-            cooked_inputs,
-            rule.recipe,
-            rule.help
-        )
+        if rule.depfile is not None:
+            rule.depfile = match.cook_name(rule.depfile)
 
         self._resolve_inputs(rule)
         self.add_rule(rule)
@@ -126,6 +307,9 @@ class Macher:
         if isinstance(inp, Rule):
             return inp
 
+        if isinstance(inp, Target) and inp.name in self.rules_by_name:
+            return self.rules_by_name[inp.name]
+
         if isinstance(inp, str):
             rule = self.find_rule(inp)
 
@@ -144,38 +328,772 @@ class Macher:
         self.add_rule( rule )
         return rule
 
-    def execute(self, rule: Rule):
+    def _recipe_context(self, rule: Rule) -> Context:
         first = rule.inputs[0] if len(rule.inputs) else None
 
-        ctx = self.context.new_child({
+        return self.context.new_child({
             "<": first,
             "__first_input__": first,
             "^": rule.inputs,
             "__inputs__": rule.inputs,
             "@": rule.target,
             "__target__": rule.target,
+            "__targets__": rule.targets,
         })
 
-        (rule.recipe)(ctx)
+    def _acquire_slot(self) -> bytes | None:
+        return self.jobserver.acquire() if self.jobserver else None
+
+    def _release_slot(self, token: bytes | None):
+        if self.jobserver:
+            self.jobserver.release(token)
+
+    def execute(self, rule: Rule, ctx: Context | None = None, key: str | None = None):
+        if ctx is None:
+            ctx = self._recipe_context(rule)
+
+        if self._restore(rule, key):
+            rule.mark_done()
+            return
+
+        token = self._acquire_slot()
+        if self.hooks:
+            self.hooks.emit("recipe_started", rule)
+
+        start = time.monotonic()
+        error = None
+        try:
+            if rule.batch is None:
+                (rule.recipe)(ctx)
+            else:
+                self._run_batches(rule, ctx)
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            self._release_slot(token)
+            self._forget_outputs(rule)
+            self._executed(rule, time.monotonic() - start, error)
+
+        self._store(rule, key)
+
+        rule.mark_done()
+
+    async def execute_async(self, rule: Rule, ctx: Context | None = None, key: str | None = None):
+        if ctx is None:
+            ctx = self._recipe_context(rule)
+
+        loop = asyncio.get_running_loop()
+
+        if await loop.run_in_executor(None, self._restore, rule, key):
+            rule.mark_done()
+            return
+
+        # Waiting for a jobserver token blocks, do it in a thread.
+        token = await loop.run_in_executor(None, self._acquire_slot)
+        if self.hooks:
+            self.hooks.emit("recipe_started", rule)
+
+        start = time.monotonic()
+        error = None
+        try:
+            if rule.batch is None:
+                await run_recipe(rule.recipe, ctx)
+            else:
+                await loop.run_in_executor(None, self._run_batches, rule, ctx)
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            self._release_slot(token)
+            self._forget_outputs(rule)
+            self._executed(rule, time.monotonic() - start, error)
+
+        await loop.run_in_executor(None, self._store, rule, key)
+
+        rule.mark_done()
+
+    def _run_batches(self, rule: Rule, ctx: Context):
+        """
+        Runs the recipe once for each chunk of changed inputs, with $? set to
+        the chunk. The chunks are worked off in the job slot of the rule, and in
+        any further job slots that are free right away. We never wait for a slot
+        while holding one, so batch rules running side by side can't deadlock.
+        """
+        assert rule.batch is not None
+
+        changed = list(ctx.get("?") or [])
+        pending = deque( changed[i:i+rule.batch] for i in range(0, len(changed), rule.batch) ) or deque([ [] ])
+
+        def drain():
+            while True:
+                try:
+                    chunk = pending.popleft()
+                except IndexError:
+                    return
+
+                try:
+                    (rule.recipe)(ctx.new_child({ "?": chunk, "__changed_inputs__": chunk }))
+                except BaseException:
+                    # Don't start any more chunks after a failure.
+                    pending.clear()
+                    raise
+
+        def drain_in_slot(token: bytes | None):
+            try:
+                drain()
+            finally:
+                self._release_slot(token)
+
+        tokens = []
+        while self.jobserver is not None and len(tokens) < min(len(pending), self.jobs()) - 1:
+            free, token = self.jobserver.try_acquire()
+            if not free:
+                break
+
+            tokens.append(token)
+
+        if not tokens:
+            drain()
+            return
+
+        with ThreadPoolExecutor(len(tokens)) as pool:
+            futures = [ pool.submit(drain_in_slot, token) for token in tokens ]
+            drain()
+
+            for future in futures:
+                future.result()
+
+    def cache_key(self, rule: Rule, inputs: Sequence[Rule], status: Status) -> str | None:
+        """
+        Returns the key for the outputs of the given rule in the artifact cache,
+        or None if they can't be cached: only files made by scripts from files
+        are, since we can't tell what python recipes depend on.
+        """
+        if self.cache is None or not self._makes_files(rule) or status.command is None:
+            return None
+
+        digests = {}
+        for inp in inputs:
+            if not self._makes_files(inp):
+                return None
+
+            for t in inp.targets:
+                st = self.stats.stat(t.name)
+                if st is None:
+                    return None
+
+                digests[t.name] = self.db.digest(t.name, st)
+
+        if rule.depfile is not None:
+            # Until the depfile was written, we don't know everything the outputs depend on.
+            if self._depfile_deps(rule) is None:
+                return None
+
+            for name in status.implicit:
+                st = self.stats.stat(name)
+                if st is None:
+                    return None
+
+                digests[name] = self.db.digest(name, st)
+
+        # Only declared variables count, not whatever happens to be in the environment.
+        envars = { k: v for k, v in status.context.get_envars().items() if k in self.flags }
+
+        return cache_key(status.command, digests, envars, rule.get_names())
+
+    def _restore(self, rule: Rule, key: str | None) -> bool:
+        """Restores the outputs of the given rule from the artifact cache, if they are there"""
+        if key is None or self.cache is None:
+            return False
+
+        hit = self.cache.restore(key, rule.get_names())
+
+        if self.hooks:
+            self.hooks.emit("cache_hit" if hit else "cache_miss", rule)
+
+        if hit:
+            self._forget_outputs(rule)
+            self._log(f"...restored {rule} from cache.")
+
+        return hit
+
+    def _store(self, rule: Rule, key: str | None):
+        if key is None or self.cache is None:
+            return
+
+        # A recipe that didn't make all its targets has nothing for us to keep.
+        if all( os.path.isfile(name) for name in rule.get_names() ):
+            self.cache.store(key, rule.get_names())
+
+    def _executed(self, rule: Rule, seconds: float, error: BaseException | None):
+        if error is None:
+            self.db.record_duration(rule.get_name(), seconds)
+
+        if self.hooks:
+            self.hooks.emit("recipe_finished", rule, seconds, exit_code(rule.recipe, error), error)
+
+    def _forget_outputs(self, rule: Rule):
+        # The recipe may have written the targets, don't trust what we know about them.
+        for t in rule.targets:
+            if isinstance(t, File):
+                self.stats.invalidate(t.name)
+
+        if rule.depfile is not None:
+            self.stats.invalidate(rule.depfile)
+
+    def _depfile_deps(self, rule: Rule) -> list[str] | None:
+        """The inputs listed in the depfile of the given rule, or None if there is none yet"""
+        if rule.depfile is None:
+            return None
+
+        st = self.stats.stat(rule.depfile)
+        if st is None:
+            return None
+
+        return self.db.dependencies(rule.depfile, st)
+
+    def _add_implicit(self, rule: Rule, status: Status, known: dict[str, str | None]):
+        """Adds the signatures of the inputs from the depfile that weren't declared to the status"""
+        status.implicit = []
+
+        for name in self._depfile_deps(rule) or []:
+            if name in status.inputs:
+                continue
+
+            status.inputs[name] = known[name] if name in known else self._signature(File(name))
+            status.implicit.append(name)
+
+    def input_rules(self, rule: Rule) -> list[Rule]:
+        return [ self.require_rule(inp) for inp in self._resolve_inputs(rule) ]
+
+    def plan(self, rule: Rule) -> list[Rule]:
+        """
+        Resolves the full graph of rules needed for making the given rule.
+        Returns the rules in the order in which they can be made, inputs first.
+        Each rule is visited and listed only once. The graph is walked using an
+        explicit stack, so deep chains don't hit the recursion limit.
+        Raises a ValueError if the graph contains a cycle.
+        """
+        known = self.plans.get(rule)
+        if known is not None:
+            return known
+
+        if self.snapshot is not None:
+            restored = self._restore_plan(rule)
+            if restored is not None:
+                self.plans[rule] = restored
+                return restored
+
+        order: list[Rule] = []
+        finished: dict[Rule, bool] = { rule: False }
+        stack = [ ( rule, iter(self.input_rules(rule)) ) ]
+
+        while stack:
+            current, inputs = stack[-1]
+
+            for inp in inputs:
+                if inp not in finished:
+                    finished[inp] = False
+                    stack.append( ( inp, iter(self.input_rules(inp)) ) )
+                    break
+
+                if not finished[inp]:
+                    path = [ str(r) for r, _ in stack ]
+                    cycle = path[path.index(str(inp)):] + [ str(inp) ]
+                    raise ValueError( "Dependency cycle: " + " -> ".join(cycle) )
+            else:
+                stack.pop()
+                finished[current] = True
+                order.append(current)
+
+                if self.hooks:
+                    self.hooks.emit("rule_resolved", current)
+
+        if self.snapshot is not None:
+            self.snapshot.put(rule.get_name(), [ self._plan_entry(r) for r in order ])
+
+        self.plans[rule] = order
+        return order
+
+    def _plan_entry(self, rule: Rule) -> list:
+        """Describes how to recreate the given rule, see GraphSnapshot"""
+        name = rule.get_name()
+        inputs = list(rule.inputs)
+
+        if name in self.defined:
+            return [ "rule", name, inputs ]
+
+        if rule.origin is not None:
+            return [ "cooked", name, inputs, rule.origin.get_name(), rule.get_names() ]
+
+        if isinstance(rule.target, File):
+            return [ "file", name, inputs, rule.target.hashed ]
+
+        return [ "target", name, inputs ]
+
+    def _restore_plan(self, root: Rule) -> list[Rule] | None:
+        """Recreates the plan for the given rule from the snapshot. Returns None if there is none."""
+        assert self.snapshot is not None
+
+        entries = self.snapshot.get(root.get_name())
+        if entries is None:
+            return None
+
+        order = []
+        for kind, name, inputs, *extra in entries:
+            rule = self.rules_by_name.get(name)
+
+            if rule is None:
+                if kind == "cooked" and extra[0] in self.rules_by_name:
+                    pattern = self.rules_by_name[extra[0]]
+                    targets = [ t.get_cooked(n) for t, n in zip(pattern.targets, extra[1]) ]
+                    rule = pattern.cook(targets, inputs)
+
+                    match = pattern.matches(name)
+                    if match is not None and any( isinstance(inp, Glob) for inp in pattern.inputs ):
+                        rule.globbed = self._cook_inputs(pattern, match)
+                elif kind == "file":
+                    rule = self.make_rule(File(name, extra[0]))
+                elif kind == "target":
+                    rule = self.make_rule(Target(name))
+                else:
+                    # The Machfile doesn't define this anymore.
+                    return None
+
+                self.add_rule(rule)
+
+            if rule.globbed is None and any( isinstance(inp, Glob) for inp in rule.inputs ):
+                rule.globbed = list(rule.inputs)
+
+            if rule.globbed is not None and not self._globs_match(rule.globbed, inputs):
+                # Files were added or removed since.
+                return None
 
-        # Make each target only once
-        rule.target.done = True
+            rule.inputs = inputs
+            order.append(rule)
+
+            if self.hooks:
+                self.hooks.emit("rule_resolved", rule)
+
+        return order
+
+    def _globs_match(self, declared: Sequence[InputLike], inputs: Sequence[str]) -> bool:
+        """Checks that the globs among the given declared inputs still expand to what's in the given input names"""
+        pos = 0
+        for inp in declared:
+            if isinstance(inp, Glob):
+                names = inp.names(self.dirs.glob(inp.pattern))
+                if list(inputs[pos:pos+len(names)]) != names:
+                    return False
+
+                pos += len(names)
+            else:
+                pos += 1
+
+        return pos == len(inputs)
+
+    def _signature(self, target: Target) -> str | None:
+        """Returns a string that changes whenever the given file changes"""
+        if not isinstance(target, File):
+            return None
+
+        st = self.stats.stat(target.name)
+        if st is None:
+            return None
+
+        if target.hashed:
+            return self.db.digest(target.name, st)
+
+        return f"{st.st_mtime_ns}:{st.st_size}"
+
+    def _makes_files(self, rule: Rule) -> bool:
+        return all( isinstance(t, File) for t in rule.targets )
+
+    def _rule_signature(self, rule: Rule) -> str | None:
+        """Returns a string that changes whenever any of the files made by the given rule changes"""
+        if len(rule.targets) == 1:
+            return self._signature(rule.target)
+
+        sigs = [ self._signature(t) for t in rule.targets ]
+        if any( sig is None for sig in sigs ):
+            return None
+
+        return " ".join( sig for sig in sigs if sig is not None )
+
+    def check(
+        self,
+        rule: Rule,
+        inputs: Sequence[Rule] | None = None,
+        changed: Container[Rule] = ()
+    ) -> Status:
+        """
+        Determines whether the given rule needs to be made. The reason is
+        recorded in the returned Status. The rule is outdated if any of the
+        inputs in changed were made during this build.
+        """
+        if inputs is None:
+            inputs = self.input_rules(rule)
+
+        status = self._check(rule, inputs, changed)
+
+        if status.outdated:
+            # Not known when the command is signed, so it doesn't change the signature.
+            changed_inputs = self._changed_inputs(rule, inputs, changed, status)
+            status.context["?"] = changed_inputs
+            status.context["__changed_inputs__"] = changed_inputs
+
+        return status
+
+    def _changed_inputs(self, rule: Rule, inputs: Sequence[Rule], changed: Container[Rule], status: Status) -> list[str]:
+        """
+        Returns the names of the inputs that changed since the given rule was
+        made last: the ones made during this build, the ones whose signature
+        differs from the build database, or, without a record there, the ones
+        newer than the targets. If any target is missing, or the command
+        changed, that's all inputs.
+        """
+        names = list(rule.inputs)
+
+        if any( t.outdated(None, self.stats) for t in rule.targets ):
+            return names
+
+        record = self.db.get(rule.target.name)
+        if record is not None and record["command"] != status.command:
+            return names
+
+        for name in status.implicit:
+            if record is not None:
+                implicit_changed = record["inputs"].get(name) != status.inputs[name]
+            else:
+                implicit_changed = any( t.outdated(File(name), self.stats) for t in rule.targets )
+
+            if implicit_changed:
+                # Something like a header changed, that concerns all inputs.
+                return names
+
+        result = []
+        for name, inp in zip(names, inputs):
+            if inp in changed:
+                result.append(name)
+            elif record is not None:
+                if record["inputs"].get(inp.get_name()) != status.inputs.get(inp.get_name()):
+                    result.append(name)
+            elif any( t.outdated(it, self.stats) for t in rule.targets for it in inp.targets ):
+                result.append(name)
+
+        return result
+
+    def _check(self, rule: Rule, inputs: Sequence[Rule], changed: Container[Rule]) -> Status:
+        target = rule.target
+        ctx = self._recipe_context(rule)
+
+        if target.done:
+            # Make each target only once
+            return Status(ctx, None, {})
+
+        status = Status(
+            ctx,
+            signature(rule.recipe, ctx) if isinstance(target, File) else None,
+            { inp.get_name(): self._rule_signature(inp) for inp in inputs }
+        )
+        self._add_implicit(rule, status, {})
+
+        if isinstance(target, File) and ( target.hashed or rule.restat ):
+            status.output = self._rule_signature(rule)
+
+        missing = next( ( t for t in rule.targets if t.outdated(None, self.stats) ), None )
+
+        if missing is not None:
+            status.reason = "missing" if isinstance(missing, File) else "not made yet"
+
+            if len(rule.targets) > 1:
+                status.reason = f"{missing} {status.reason}"
+
+            return status
+
+        for inp in inputs:
+            if inp in changed:
+                status.reason = f"{inp} was made"
+                return status
+
+        record = self.db.get(target.name)
+
+        if record is None:
+            # We don't know how the target was made, go by modification time.
+            # With several targets, this compares the oldest one.
+            for inp in inputs:
+                if any( t.outdated(it, self.stats) for t in rule.targets for it in inp.targets ):
+                    status.reason = f"older than {inp}"
+                    return status
+
+            for name in status.implicit:
+                if any( t.outdated(File(name), self.stats) for t in rule.targets ):
+                    status.reason = f"older than {name}"
+                    return status
+
+            if isinstance(target, File):
+                # Remember the target as up to date with its inputs.
+                self._record(rule, status)
+
+            return status
+
+        if record["command"] != status.command:
+            status.reason = "command changed"
+            return status
+
+        for name, sig in status.inputs.items():
+            if sig is None:
+                status.reason = f"{name} is not a file"
+                return status
+
+            if record["inputs"].get(name) != sig:
+                status.reason = f"{name} changed"
+                return status
+
+        if record["inputs"].keys() != status.inputs.keys():
+            status.reason = "inputs changed"
+
+        return status
+
+    def outdated(self, rule: Rule, inputs: Sequence[Rule] | None = None) -> bool:
+        return self.check(rule, inputs).outdated
+
+    def _record(self, rule: Rule, status: Status):
+        if not isinstance(rule.target, File):
+            return
+
+        if any( sig is None for sig in status.inputs.values() ):
+            return
+
+        if not status.inputs and status.command is None:
+            # Nothing worth remembering, e.g. for source files.
+            return
+
+        self.db.record(rule.get_name(), status.command, status.inputs)
+
+    def made(self, rule: Rule, status: Status) -> bool:
+        """
+        Called after the given rule was made successfully.
+        Returns False if the recipe left the target unchanged, that is,
+        if it didn't touch a restat target or didn't change the content
+        of a hashed target.
+        """
+        if rule.depfile is not None:
+            # The recipe wrote a new depfile, record the inputs it lists now.
+            old = { name: status.inputs.pop(name) for name in status.implicit }
+            self._add_implicit(rule, status, old)
+
+        self._record(rule, status)
+
+        if status.output is not None:
+            return self._rule_signature(rule) != status.output
+
+        return True
+
+    def _count_option(self, name: str, minimum: int = 0) -> int:
+        value = self.options[name]
+
+        if isinstance(value, bool) or not value.isdigit() or int(value) < minimum:
+            raise ValueError( f"Expected a number of at least {minimum} for option {name}, got {value}" )
+
+        return int(value)
+
+    def jobs(self) -> int:
+        """
+        The number of jobs to run at once. Unless given on the command line,
+        this is the limit of the jobserver we are a client of, if any, or 1.
+        """
+        if self.options['jobs'] == '':
+            if self.jobserver is None:
+                return 1
+
+            return self.jobserver.limit or os.cpu_count() or 1
+
+        return self._count_option('jobs', 1)
+
+    def _number_option(self, name: str) -> float | None:
+        value = self.options[name]
+        if value == '':
+            return None
+
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise ValueError( f"Expected a number for option {name}, got {value}" )
+
+    def throttle(self) -> Throttle:
+        """
+        Holds back jobs while the load average is above the maxload option, or
+        less than minmem MB of memory are available.
+        """
+        return Throttle(self._number_option('maxload'), self._number_option('minmem'))
+
+    def _setup_jobserver(self):
+        """
+        Joins the jobserver advertised by MAKEFLAGS, or starts one for our child
+        processes if we run more than one job, so nested builds share our job slots.
+        """
+        if self.jobserver is None:
+            makeflags = self.context.get('MAKEFLAGS')
+            self.jobserver = Jobserver.from_makeflags(makeflags) if makeflags else None
+
+        if self.jobserver is None and self.jobs() > 1:
+            self.jobserver = Jobserver.create(self.jobs())
+            self.context['MAKEFLAGS'] = self.jobserver.makeflags
+
+        if self.jobserver is not None:
+            self.env.pass_fds = self.jobserver.pass_fds
+
+    def _start_workers(self):
+        """Forks the workers for isolated recipes, if there are any, before we start other threads"""
+        if self.workers is None and any( isinstance(r.recipe, Isolated) for r in self.rules ):
+            self.workers = Workers(self.jobs())
+
+    def _open_db(self):
+        path = self.options['db']
+
+        # Without a path, the database lives in memory only.
+        if isinstance(path, str) and path != '' and path != self.db.path:
+            self.db = BuildDb(path)
+
+    def _open_dirs(self):
+        """Opens the index of directory listings used for globs, kept next to the build database"""
+        path = self.options['db']
+        if not isinstance(path, str) or path == '':
+            return
+
+        path = os.path.join(os.path.dirname(path), "dirs")
+        if path != self.dirs.path:
+            self.dirs = DirIndex(path)
+
+    def _open_cache(self):
+        if self.cache is not None:
+            return
+
+        path = self.options['cache']
+        url = self.options['remote']
+        remote = RemoteCache(url) if isinstance(url, str) and url != '' else None
+
+        if remote is not None and path == '':
+            # Downloads go through a local cache.
+            path = os.path.join(os.path.dirname(str(self.options['db'])) or '.mach', 'cache')
+
+        if isinstance(path, str) and path != '':
+            limit = self._count_option('cachesize', 1) * 1024 * 1024
+            self.cache = ArtifactCache(os.path.expanduser(path), limit, remote)
+
+    def _open_snapshot(self):
+        """
+        Opens the snapshot of resolved rule graphs, kept next to the build
+        database. It is keyed by the Machfile and by the rules it defined.
+        """
+        path = self.options['db']
+        if self.machfile_key is None or not isinstance(path, str) or path == '':
+            return
+
+        if self.snapshot is not None:
+            return
+
+        self.defined = set(self.rules_by_name)
+        definitions = [ ( r.get_names(), type(r.target).__name__, [ str(i) for i in r.inputs ] ) for r in self.rules ]
+        key = GraphSnapshot.make_key([ self.machfile_key, definitions ])
+
+        self.snapshot = GraphSnapshot(os.path.join(os.path.dirname(path), "graph"), key)
+
+    def _setup_build(self):
+        self._setup_jobserver()
+        self._start_workers()
+        self.stats.scan_dirs = bool(self.options['scandirs'])
+        self.env.use_pool(self._count_option('shells'))
+        self._open_db()
+        self._open_dirs()
+        self._open_cache()
+        self._open_snapshot()
+
+    def tracer(self) -> Tracer | None:
+        """
+        Records a Chrome trace into the file given by the trace option. The
+        same tracer records all builds, e.g. of several targets given on the
+        command line, so the file covers everything that was made.
+        """
+        path = self.options['trace']
+        if not isinstance(path, str) or path == '':
+            return None
+
+        if self.tracing is None or self.tracing.path != path:
+            self.tracing = Tracer(path)
+
+        return self.tracing
+
+    def watch(self, rules: list[Rule]):
+        """Makes the given rules, then makes them again whenever their inputs change"""
+        Watcher(self, rules).run()
 
     def mach(self, rule: Rule):
-        self._log(f"making {rule}...")
-        outdated = rule.target.outdated()
+        if self.options['engine'] == 'async':
+            asyncio.run(self.amach(rule))
+            return
+
+        if self.options['engine'] != 'threads':
+            raise ValueError( f"Unknown engine {self.options['engine']}" )
+
+        self._setup_build()
+        tracer = self.tracer()
+        self._start_build(rule)
+
+        error = None
+        try:
+            Scheduler(self, self.jobs(), self.throttle(), tracer).run(rule)
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            self._finish_build(rule, tracer, error)
+
+    async def amach(self, rule: Rule):
+        """
+        Makes the given rule using asyncio: scripts run as asyncio subprocesses,
+        other recipes in the loop's default executor. Up to the number of jobs
+        given by the jobs option are in flight at any time.
+        """
+        self._setup_build()
+        tracer = self.tracer()
+        self._start_build(rule)
+
+        error = None
+        try:
+            await AsyncScheduler(self, self.jobs(), self.throttle(), tracer).run_async(rule)
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            self._finish_build(rule, tracer, error)
+
+    def _start_build(self, rule: Rule):
+        if self.hooks:
+            self.hooks.emit("build_started", rule)
 
-        input_names = self._resolve_inputs(rule)
-        for inp in input_names:
-            inp_rule = self.require_rule(inp)
-            self.mach(inp_rule)
-            outdated = outdated or rule.target.outdated(inp_rule.target)
+    def _finish_build(self, rule: Rule, tracer: Tracer | None, error: BaseException | None):
+        if self.workers is not None:
+            self.workers.close()
+            self.workers = None
 
-        if outdated:
-            self.execute(rule)
-            self._log(f"...made {rule}.")
-        else:
-            self._log(f"...got {rule}.")
+        self.db.save()
+        self.dirs.save()
+
+        if self.snapshot is not None:
+            self.snapshot.save()
+
+        if self.cache is not None:
+            self.cache.flush()
+            self.cache.trim()
+
+        if tracer:
+            tracer.save()
+
+        if self.hooks:
+            self.hooks.emit("build_finished", rule, error)
 
     def _recipe(self, recipe: RecipeLike | None) -> Recipe:
         if recipe is None:
@@ -187,19 +1105,13 @@ class Macher:
         elif isinstance(recipe, str):  # note that str is a Sequence
             return self.script(recipe)
         elif isinstance(recipe, Sequence):
-            rr = [self._recipe(r) for r in recipe]
-
-            def sq(ctx: Context):
-                for r in rr:
-                    r(ctx)
-
-            return sq
+            return Steps([self._recipe(r) for r in recipe])
 
         assert isinstance(recipe, Callable)
         return recipe
 
     def script(self, cmd: str, **kwargs) -> Script:
-        return Script(self.env, cmd, kwargs)
+        return Script(self.env, cmd, kwargs, self.hooks)
 
     def set_var(self, name: str, value: VarValue):
         self.context[name] = value
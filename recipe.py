@@ -1,6 +1,8 @@
 import textwrap
+import time
 
 from env import Environment, OutputMode
+from hooks import Hooks
 from wert import Context, expand_all
 
 from typing import TypeAlias, Callable, Sequence, Any
@@ -15,14 +17,24 @@ DEFAULT_OPTIONS = {
     'envars': {},
 }
 
+class ScriptError(Exception):
+    """Raised when a script fails, carries the exit code"""
+    code: int
+
+    def __init__(self, code: int):
+        super().__init__(f"Script returned error code {code}.")
+        self.code = code
+
 class Script:
     env: Environment
     cmd: str
     options: Options
+    hooks: Hooks
 
-    def __init__(self, env: Environment, cmd: str, options: Options|None):
+    def __init__(self, env: Environment, cmd: str, options: Options|None, hooks: Hooks|None = None):
         # NOTE: we have to use __dict__ in the constructor to bypass __setattr__!
         self.__dict__['env'] = env
+        self.__dict__['hooks'] = hooks if hooks is not None else Hooks()
         self.__dict__['cmd'] = textwrap.dedent(cmd.strip("\r\n"))
 
         options = options or {}
@@ -37,8 +49,15 @@ class Script:
     def __setattr__(self, name, value):
         self.options[name] = value
 
-    def __call__(self, ctx):
-        expanded_cmd = expand_all(self.cmd, ctx)
+    def expand(self, ctx: Context) -> str:
+        return expand_all(self.cmd, ctx)
+
+    def prepare(self, ctx: Context) -> tuple[str, Options]:
+        """
+        Expands the command for the given context, and returns it along with
+        the keyword arguments for Environment.execute.
+        """
+        expanded_cmd = self.expand(ctx)
 
         if self.echo:
             print(textwrap.indent(expanded_cmd, "> ").strip("\r\n"))
@@ -53,8 +72,63 @@ class Script:
         del kwargs['echo']
         del kwargs['check']
 
-        code = self.env.execute(expanded_cmd, **kwargs)
+        return ( expanded_cmd, kwargs )
 
+    def verify(self, code: int):
         if self.check and code != 0:
             # TODO: kwargs['on_error']...
-            raise Exception(f"Script returned error code {code}.")
+            raise ScriptError(code)
+
+    def started(self, cmd: str) -> float:
+        if self.hooks:
+            self.hooks.emit("script_started", cmd)
+
+        return time.monotonic()
+
+    def finished(self, cmd: str, start: float, code: int):
+        if self.hooks:
+            self.hooks.emit("script_finished", cmd, time.monotonic() - start, code)
+
+        self.verify(code)
+
+    def __call__(self, ctx):
+        expanded_cmd, kwargs = self.prepare(ctx)
+
+        start = self.started(expanded_cmd)
+        self.finished( expanded_cmd, start, self.env.execute(expanded_cmd, **kwargs) )
+
+class Steps:
+    """A recipe that runs several recipes, one after the other"""
+    steps: list[Recipe]
+
+    def __init__(self, steps: Sequence[Recipe]):
+        self.steps = list(steps)
+
+    def __call__(self, ctx: Context):
+        for r in self.steps:
+            r(ctx)
+
+def exit_code(recipe: Recipe, error: BaseException | None) -> int | None:
+    """The exit code of a recipe that completed with the given error, None for python recipes"""
+    if error is not None:
+        return getattr(error, "code", None)
+
+    return 0 if isinstance(recipe, (Script, Steps)) else None
+
+def signature(recipe: Recipe, ctx: Context) -> str | None:
+    """
+    Returns a string that describes what the given recipe would do in the
+    given context: the expanded commands of scripts. Returns None for plain
+    callables, what they do can't be known up front.
+    """
+    if isinstance(recipe, Script):
+        return recipe.expand(ctx)
+
+    if isinstance(recipe, Steps):
+        sigs = [ signature(r, ctx) for r in recipe.steps ]
+        if all( sig is None for sig in sigs ):
+            return None
+
+        return "\n".join( sig or "" for sig in sigs )
+
+    return None
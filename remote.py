@@ -0,0 +1,193 @@
+import hashlib
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+
+_path_pattern = re.compile(r'/(cas|ac)/([0-9a-f]{64})')
+
+class RemoteCache:
+    """
+    Client for a remote cache shared by many machines, over plain HTTP.
+    Files are stored by the sha256 of their content under /cas/<digest>.
+    What a rule made is stored as an action record under /ac/<key>.
+    A missing entry is a 404.
+
+    Transfers run on a small pool of threads, so they overlap with making
+    other rules. Any error talking to the server counts as a miss: a
+    flaky cache must not break the build.
+    """
+
+    url: str
+    timeout: float
+
+    def __init__(self, url: str, workers: int = 4, timeout: float = 30.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="mach-remote")
+        self.pending: set[Future] = set()
+        self.lock = threading.Lock()
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        """Runs the given transfer in the background"""
+        future = self.pool.submit(fn, *args)
+
+        with self.lock:
+            self.pending.add(future)
+
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def drain(self):
+        """Waits for all transfers started so far"""
+        with self.lock:
+            pending = list(self.pending)
+
+        wait(pending)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+    def _open(self, method: str, path: str, data: Any = None, size: int | None = None):
+        request = urllib.request.Request(self.url + path, data=data, method=method)
+        if size is not None:
+            request.add_header("Content-Length", str(size))
+
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def has(self, kind: str, name: str) -> bool:
+        try:
+            with self._open("HEAD", f"/{kind}/{name}"):
+                return True
+        except (OSError, ValueError):
+            return False
+
+    def get(self, kind: str, name: str, path: str) -> bool:
+        """Downloads an entry into the given file. Returns False if there is none."""
+        try:
+            with self._open("GET", f"/{kind}/{name}") as response, open(path, "wb") as f:
+                shutil.copyfileobj(response, f, 1 << 20)
+                return True
+        except (OSError, ValueError):
+            return False
+
+    def put(self, kind: str, name: str, path: str) -> bool:
+        """Uploads the given file as an entry. Returns False if that failed."""
+        try:
+            with open(path, "rb") as f:
+                with self._open("PUT", f"/{kind}/{name}", f, os.fstat(f.fileno()).st_size):
+                    return True
+        except (OSError, ValueError):
+            return False
+
+class _Handler(BaseHTTPRequestHandler):
+    """Serves a directory as a remote cache, see RemoteCache"""
+
+    root: str
+
+    def _entry(self) -> tuple[str, str] | None:
+        match = _path_pattern.fullmatch(self.path)
+        if match is None:
+            self.send_error(404)
+            return None
+
+        kind, name = match.groups()
+        return kind, os.path.join(self.root, kind, name[:2], name)
+
+    def do_HEAD(self):
+        self._send(head=True)
+
+    def do_GET(self):
+        self._send(head=False)
+
+    def _send(self, head: bool):
+        entry = self._entry()
+        if entry is None:
+            return
+
+        try:
+            f = open(entry[1], "rb")
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+
+        with f:
+            self.send_response(200)
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+
+            if not head:
+                shutil.copyfileobj(f, self.wfile, 1 << 20)
+
+    def do_PUT(self):
+        entry = self._entry()
+        if entry is None:
+            return
+
+        kind, path = entry
+        size = int(self.headers.get("Content-Length", "0"))
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        digest = hashlib.sha256()
+
+        with os.fdopen(fd, "wb") as f:
+            while size > 0:
+                chunk = self.rfile.read(min(size, 1 << 20))
+                if not chunk:
+                    break
+
+                f.write(chunk)
+                digest.update(chunk)
+                size -= len(chunk)
+
+        if size > 0 or ( kind == "cas" and digest.hexdigest() != os.path.basename(path) ):
+            os.unlink(tmp)
+            self.send_error(400)
+            return
+
+        os.replace(tmp, path)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format: str, *args: Any):
+        pass
+
+def serve(root: str, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    Creates a server for a remote cache, keeping entries in the given
+    directory. With port 0, a free port is picked. Call serve_forever()
+    on the result to run it.
+    """
+    handler = type("Handler", (_Handler,), { "root": root })
+    return ThreadingHTTPServer((host, port), handler)
+
+def main():
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} DIR [PORT]")
+        exit(1)
+
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    server = serve(sys.argv[1], "", port)
+
+    print(f"Serving {sys.argv[1]} on port {server.server_address[1]}")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any
+
+from target import Rule
+from throttle import Throttle
+from tracing import Tracer
+from wert import Context
+
+class Status:
+    """
+    The outcome of checking whether a rule needs to be made, along with
+    what we learned while checking: the command the recipe would run and
+    the signatures of the inputs, including the implicit ones read from the
+    rule's depfile, to be recorded once the rule was made.
+    """
+
+    reason: str | None
+    context: Context
+    command: str | None
+    inputs: dict[str, str | None]
+    implicit: list[str]
+    output: str | None
+    key: str | None
+
+    def __init__(self, context: Context, command: str | None, inputs: dict[str, str | None]):
+        self.reason = None
+        self.context = context
+        self.command = command
+        self.inputs = inputs
+        self.implicit = []
+        self.output = None
+        self.key = None
+
+    @property
+    def outdated(self) -> bool:
+        return self.reason is not None
+
+
+class Scheduler:
+    """
+    Runs the rules needed for making a target. Each rule in the graph is
+    checked and made at most once. With more than one job, recipes run on a
+    pool of worker threads, and a rule is started as soon as all its inputs
+    are finished, so independent subtrees are made at the same time.
+
+    Outdatedness checks and all bookkeeping happen on the calling thread,
+    only recipes are executed by the workers.
+
+    Among the rules that could be started, the ones with the longest
+    remaining path to the root are started first, so long chains don't
+    end up holding up the build at the end. Path lengths are estimated
+    from how long each rule took last time. With a single job, that
+    wouldn't make the build any faster, rules are made in the order of
+    the plan instead, as declared.
+    """
+
+    jobs: int
+    inputs: dict[Rule, list[Rule]]
+    parents: dict[Rule, list[Rule]]
+    waiting: dict[Rule, int]
+    ready: deque[Rule]
+    runnable: list[tuple[float, int, int, Rule, Status]]
+    priority: dict[Rule, float]
+    position: dict[Rule, int]
+    changed: set[Rule]
+    running: dict[Any, tuple[Rule, Status]]
+    pools: dict[str, int]
+    throttle: Throttle
+    tracer: Tracer | None
+    error: BaseException | None
+
+    def __init__(self, macher, jobs: int, throttle: Throttle | None = None, tracer: Tracer | None = None):
+        self.macher = macher
+        self.jobs = jobs
+        self.throttle = throttle or Throttle()
+        self.tracer = tracer
+
+    def _load(self, root: Rule):
+        rules = self.macher.plan(root)
+
+        self.inputs = {}
+        self.waiting = {}
+        self.parents = { r: [] for r in rules }
+        self.ready = deque()
+        self.runnable = []
+        self.order = itertools.count()
+        self.changed = set()
+        self.running = {}
+        self.pools = {}
+        self.error = None
+
+        for rule in rules:
+            inputs = self.macher.input_rules(rule)
+            self.inputs[rule] = inputs
+            self.waiting[rule] = len(inputs)
+
+            for inp in inputs:
+                self.parents[inp].append(rule)
+
+            if not inputs:
+                self.ready.append(rule)
+
+            if rule.pool is not None and rule.pool not in self.macher.pools:
+                raise ValueError(f"Undeclared pool {rule.pool} used by {rule}")
+
+        self.priority = self._critical_paths(rules)
+        self.position = { r: i for i, r in enumerate(rules) }
+
+    def _critical_paths(self, rules: list[Rule]) -> dict[Rule, float]:
+        """
+        Estimates how long it takes from starting each rule until the root is
+        made, following the slowest path. Rules we have no timing for count
+        as long as the average rule that we know, or 1 if we know none.
+        """
+        durations = { r: self.macher.db.duration(r.get_name()) for r in rules }
+        known = [ d for d in durations.values() if d is not None ]
+        default = sum(known) / len(known) if known else 1.0
+
+        paths: dict[Rule, float] = {}
+
+        # Rules come inputs first, so dependents are done before their inputs.
+        for rule in reversed(rules):
+            duration = durations[rule]
+            after = max( ( paths[p] for p in self.parents[rule] ), default=0.0 )
+            paths[rule] = after + ( default if duration is None else duration )
+
+        return paths
+
+    def _finish(self, rule: Rule):
+        for p in self.parents[rule]:
+            self.waiting[p] -= 1
+            if self.waiting[p] == 0:
+                self.ready.append(p)
+
+    def _busy(self) -> bool:
+        """Whether there is anything left to do or to wait for"""
+        pending = bool(self.ready) or bool(self.runnable)
+        return bool(self.running) or ( pending and self.error is None )
+
+    def _poll_interval(self) -> float | None:
+        """How long to wait for running jobs before checking the throttle again"""
+        return self.throttle.interval if self.throttle and self.runnable else None
+
+    def _admit(self, rule: Rule) -> bool:
+        """Whether the given rule's pool has room for another job"""
+        if rule.pool is None:
+            return True
+
+        return self.pools.get(rule.pool, 0) < self.macher.pools[rule.pool]
+
+    def _schedule(self) -> list[tuple[Rule, Status]]:
+        """
+        Checks the rules that are ready, and returns the outdated ones that
+        can be started now. Rules are held back while the number of jobs is
+        exhausted, while their pool is full, or while the throttle says the
+        system is overloaded, unless nothing is running at all.
+        """
+        while self.ready and self.error is None:
+            rule = self.ready.popleft()
+            status = self._check(rule)
+
+            if status is not None:
+                if self.jobs == 1:
+                    item = ( 0.0, 0, self.position[rule], rule, status )
+                else:
+                    # Longest path first, then the rule with the most inputs.
+                    item = ( -self.priority[rule], -len(self.inputs[rule]), next(self.order), rule, status )
+
+                heapq.heappush(self.runnable, item)
+
+        start: list[tuple[Rule, Status]] = []
+        held: list[tuple[float, int, int, Rule, Status]] = []
+
+        while self.runnable and self.error is None:
+            if len(self.running) + len(start) >= self.jobs:
+                break
+
+            if ( self.running or start ) and self.throttle and self.throttle.blocked():
+                break
+
+            item = heapq.heappop(self.runnable)
+            rule, status = item[3], item[4]
+
+            if not self._admit(rule):
+                held.append(item)
+                continue
+
+            if rule.pool is not None:
+                self.pools[rule.pool] = self.pools.get(rule.pool, 0) + 1
+
+            start.append( ( rule, status ) )
+
+            if self.tracer:
+                self.tracer.start(rule, status.reason)
+
+        for item in held:
+            heapq.heappush(self.runnable, item)
+
+        return start
+
+    def _check(self, rule: Rule) -> Status | None:
+        """
+        Checks whether the given rule needs to be made. Returns None and
+        finishes the rule if it's up to date.
+        """
+        self.macher._log(f"making {rule}...")
+
+        started = self.tracer.now() if self.tracer else 0.0
+        status = self.macher.check(rule, self.inputs[rule], self.changed)
+
+        if self.tracer:
+            self.tracer.check(rule, started, status.reason)
+
+        if self.macher.hooks:
+            self.macher.hooks.emit("rule_checked", rule, status.reason)
+
+        if not status.outdated:
+            self.macher._log(f"...got {rule}.")
+            self._finish(rule)
+            return None
+
+        status.key = self.macher.cache_key(rule, self.inputs[rule], status)
+
+        if status.key is not None:
+            # Start downloading from a remote cache while the rule waits for a job slot.
+            self.macher.cache.prefetch(status.key)
+
+        return status
+
+    def _completed(self, key: Any, exc: BaseException | None):
+        """Called when the recipe of a running rule completed, with the exception it raised, if any"""
+        rule, status = self.running.pop(key)
+
+        if self.tracer:
+            self.tracer.end(rule, exc)
+
+        if rule.pool is not None:
+            self.pools[rule.pool] -= 1
+
+        if exc is not None:
+            # Let running jobs finish, but don't start new ones.
+            self.error = self.error or exc
+            return
+
+        self._made(rule, status)
+
+    def _made(self, rule: Rule, status: Status):
+        if self.macher.made(rule, status):
+            # Dependents have to be made, whatever their timestamps say.
+            self.changed.add(rule)
+            self.macher._log(f"...made {rule}.")
+        else:
+            self.macher._log(f"...made {rule} (unchanged).")
+
+        self._finish(rule)
+
+    def run(self, root: Rule):
+        self._load(root)
+
+        if self.jobs == 1:
+            # Make everything on this thread.
+            while self._busy():
+                for rule, status in self._schedule():
+                    self.running[rule] = ( rule, status )
+
+                    try:
+                        self.macher.execute(rule, status.context, status.key)
+                    except BaseException as exc:
+                        self._completed(rule, exc)
+                    else:
+                        self._completed(rule, None)
+        else:
+            self._run_pool()
+
+        if self.error is not None:
+            raise self.error
+
+    def _run_pool(self):
+        with ThreadPoolExecutor(self.jobs) as pool:
+            while self._busy():
+                for rule, status in self._schedule():
+                    future = pool.submit(self.macher.execute, rule, status.context, status.key)
+                    self.running[future] = ( rule, status )
+
+                if not self.running:
+                    continue
+
+                done, _ = wait(self.running, timeout=self._poll_interval(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._completed(future, future.exception())
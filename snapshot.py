@@ -0,0 +1,139 @@
+import hashlib
+import importlib.util
+import json
+import marshal
+import os
+import sys
+
+from types import CodeType
+from typing import Any, Iterable
+
+_VERSION = 1
+
+Entry = list[Any]
+
+def compile_cached(path: str, cache: str) -> tuple[CodeType, str]:
+    """
+    Compiles the given python file, re-using the bytecode in the cache file
+    if it was compiled from the same source. Returns the code and a digest
+    of the source.
+    """
+    with open(path, "rb") as f:
+        source = f.read()
+
+    digest = hashlib.sha256(source).hexdigest()
+    header = importlib.util.MAGIC_NUMBER + bytes.fromhex(digest)
+
+    try:
+        with open(cache, "rb") as f:
+            data = f.read()
+
+        if data.startswith(header):
+            return marshal.loads(data[len(header):]), digest
+    except (OSError, ValueError, EOFError):
+        pass
+
+    code = compile(source, path, "exec")
+
+    try:
+        directory = os.path.dirname(cache)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        tmp = cache + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header + marshal.dumps(code))
+
+        os.replace(tmp, cache)
+    except OSError:
+        # Not being able to cache just makes the next start slower.
+        pass
+
+    return code, digest
+
+def local_modules(directory: str) -> list[tuple[str, int, int]]:
+    """The python files below the given directory that were imported, with their mtime and size"""
+    directory = os.path.abspath(directory) + os.sep
+    found = []
+
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if not path or not os.path.abspath(path).startswith(directory):
+            continue
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+
+        found.append( ( path, st.st_mtime_ns, st.st_size ) )
+
+    return sorted(found)
+
+class GraphSnapshot:
+    """
+    The resolved rule graphs of earlier builds, so a build doesn't have to
+    match patterns, cook rules and walk the graph again. For each target
+    that was made, the snapshot lists the rules needed for making it, in
+    the order of Macher.plan, along with how to recreate rules that were
+    not defined by the Machfile itself:
+
+        [ "rule", name, inputs ]             defined by the Machfile
+        [ "cooked", name, inputs, pattern ]  cooked from a pattern rule
+        [ "file", name, inputs, hashed ]     an implicit rule for a source file
+        [ "target", name, inputs ]           an implicit rule for another target
+
+    The snapshot is only used if its key matches, the key covers everything
+    the graph is derived from: the Machfile, the modules it imported, and
+    the rules it defined.
+    """
+
+    path: str
+    key: str
+    plans: dict[str, list[Entry]]
+    dirty: bool
+
+    def __init__(self, path: str, key: str):
+        self.path = path
+        self.key = key
+        self.plans = {}
+        self.dirty = False
+
+        self.load()
+
+    @staticmethod
+    def make_key(parts: Iterable[Any]) -> str:
+        text = json.dumps([ _VERSION, *parts ], separators=(",", ":"))
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get("key") == self.key:
+            self.plans = data.get("plans", {})
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({ "key": self.key, "plans": self.plans }, f, separators=(",", ":"))
+
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def get(self, name: str) -> list[Entry] | None:
+        return self.plans.get(name)
+
+    def put(self, name: str, entries: list[Entry]):
+        self.plans[name] = entries
+        self.dirty = True
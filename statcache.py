@@ -0,0 +1,96 @@
+import os
+
+class StatCache:
+    """
+    Caches file metadata, so each path is stat'ed only once per build.
+    Missing files are cached as None.
+
+    If scan_dirs is set, the first lookup of a path lists its entire directory
+    using os.scandir, so lookups of other files in the same directory, in
+    particular of files that don't exist, don't need a system call of their own.
+    Invalidating a path only forgets that one entry of the listing.
+    """
+
+    scan_dirs: bool
+    _stats: dict[str, os.stat_result | None]
+    _dirs: dict[str, dict[str, os.DirEntry | None] | None]
+
+    def __init__(self, scan_dirs: bool = False):
+        self.scan_dirs = scan_dirs
+        self._stats = {}
+        self._dirs = {}
+
+    def stat(self, path: str) -> os.stat_result | None:
+        path = os.path.normpath(path)
+
+        try:
+            return self._stats[path]
+        except KeyError:
+            pass
+
+        if self.scan_dirs:
+            st = self._stat_from_dir(path)
+        else:
+            st = _stat(path)
+
+        self._stats[path] = st
+        return st
+
+    def mtime(self, path: str) -> float | None:
+        st = self.stat(path)
+        return None if st is None else st.st_mtime
+
+    def prefetch(self, directory: str):
+        """Lists the given directory, so its files don't have to be stat'ed one by one"""
+        directory = os.path.normpath(directory)
+
+        try:
+            with os.scandir(directory) as it:
+                self._dirs[directory] = { entry.name: entry for entry in it }
+        except OSError:
+            self._dirs[directory] = None
+
+    def _stat_from_dir(self, path: str) -> os.stat_result | None:
+        directory, name = os.path.split(path)
+        directory = directory or "."
+
+        if directory not in self._dirs:
+            self.prefetch(directory)
+
+        entries = self._dirs.get(directory)
+        if entries is None:
+            # Not a readable directory (or just invalidated), fall back to a plain stat.
+            return _stat(path)
+
+        if name not in entries:
+            return None
+
+        entry = entries[name]
+        if entry is None:
+            # Invalidated since the directory was listed.
+            return _stat(path)
+
+        try:
+            return entry.stat()
+        except OSError:
+            return None
+
+    def invalidate(self, path: str):
+        """Forgets what we know about the given path, e.g. after a recipe wrote to it"""
+        path = os.path.normpath(path)
+        self._stats.pop(path, None)
+
+        directory, name = os.path.split(path)
+        entries = self._dirs.get(directory or ".")
+        if entries is not None:
+            entries[name] = None
+
+    def clear(self):
+        self._stats.clear()
+        self._dirs.clear()
+
+def _stat(path: str) -> os.stat_result | None:
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
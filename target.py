@@ -1,11 +1,13 @@
 from __future__ import annotations
 
-import os
+import copy
 import re
-from collections.abc import Sequence
+from collections.abc import Sequence, Iterable, Iterator
+from functools import cached_property
 from typing import TypeAlias, override
 
 from recipe import Recipe
+from statcache import StatCache
 
 class TargetMatch:
     target: Target
@@ -52,7 +54,7 @@ class Target:
         else:
             return None
 
-    def outdated(self, _other: Target | None = None) -> bool:
+    def outdated(self, _other: Target | None = None, _stats: StatCache | None = None) -> bool:
         return not self.done
 
     def get_cooked(self, name) -> Target:
@@ -64,38 +66,63 @@ class Target:
 
 
 class File(Target):
+    hashed: bool
+
+    def __init__(self, name: str, hashed: bool = False):
+        super().__init__(name)
+
+        # If set, the file's content is compared instead of its modification time,
+        # so dependents aren't made again when the file was re-written unchanged.
+        self.hashed = hashed
+
     @override
-    def outdated(self, other: Target | None = None) -> bool:
+    def outdated(self, other: Target | None = None, stats: StatCache | None = None) -> bool:
         if self.done:
             return False
 
-        try:
-            mtime = os.path.getmtime(self.name)
-            if other is None:
-                return False
-            elif isinstance(other, File):
-                other_mtime = os.path.getmtime(other.name)
-                return mtime < other_mtime
+        if stats is None:
+            stats = StatCache()
 
-        except IOError:
-            pass
+        mtime = stats.mtime(self.name)
+        if mtime is None:
+            return True
+
+        if other is None:
+            return False
+        elif isinstance(other, File):
+            other_mtime = stats.mtime(other.name)
+            return other_mtime is None or mtime < other_mtime
 
         return True
 
     @override
     def get_cooked(self, name):
-         return File(name)
+         return File(name, self.hashed)
 
 
 class Pattern(Target):
     name: str
-    pattern: re.Pattern
+    prefix: str
+    suffix: str
+    hashed: bool
 
-    def __init__(self, name: str):
+    def __init__(self, name: str, hashed: bool = False):
         super().__init__(name)
+        self.hashed = hashed
 
-        p = name.replace("%", "(.*?)")
-        self.pattern = re.compile(p)
+        parts = name.split("%")
+        self.prefix = parts[0]
+        self.suffix = parts[-1]
+
+    @cached_property
+    def pattern(self) -> re.Pattern:
+        # Compiled on first use, defining many patterns should be cheap.
+        p = "(.*?)".join( re.escape(part) for part in self.name.split("%") )
+        return re.compile(p)
+
+    def specificity(self) -> int:
+        """The number of literal characters in the pattern"""
+        return len(self.name) - self.name.count("%")
 
     @override
     def matches(self, name: str) -> TargetMatch | None:
@@ -108,31 +135,105 @@ class Pattern(Target):
     @override
     def get_cooked(self, name):
         # XXX: always File?
-        return File(name)
+        return File(name, self.hashed)
+
+
+class Glob:
+    """
+    Stands for all files matching a wildcard pattern, as inputs of a rule,
+    see DirIndex.glob. If to is given, each file is replaced by that name,
+    with % standing for the part of the file's name matched by wildcards:
+    Glob("src/**/*.c", "build/%.o") makes src/lib/a.c into build/lib/a.o.
+    """
+
+    pattern: str
+    to: str | None
+
+    def __init__(self, pattern: str, to: str | None = None):
+        self.pattern = pattern
+        self.to = to
 
+    def names(self, paths: Sequence[str]) -> list[str]:
+        """Returns the input names for the given files matching the pattern"""
+        if self.to is None:
+            return list(paths)
+
+        # The fixed text around the wildcards is the same for every file.
+        magic = [ m.span() for m in _glob_magic_pattern.finditer(self.pattern) ]
+        start = magic[0][0] if magic else len(self.pattern)
+        suffix = len(self.pattern) - magic[-1][1] if magic else 0
+
+        return [ self.to.replace("%", p[start:len(p)-suffix]) for p in paths ]
+
+    @override
+    def __str__(self):
+        return self.pattern if self.to is None else f"{self.pattern} -> {self.to}"
+
+_glob_magic_pattern = re.compile(r'\*+|\?|\[[^]]*\]')
 
 TargetLike: TypeAlias = "Target | str"
-InputLike: TypeAlias = "Target | Rule | str"
+InputLike: TypeAlias = "Target | Rule | Glob | str"
 
 
 class Rule:
     target: Target
+    targets: list[Target]
     inputs: Sequence[InputLike]
     recipe: Recipe
     help:   str | None
+    restat: bool
+    pool:   str | None
+    batch:  int | None
+    depfile: str | None
+    globbed: Sequence[InputLike] | None
+    origin: Rule | None
 
     def __init__(
         self,
-        target: TargetLike,
+        target: TargetLike | Sequence[TargetLike],
         inputs: Sequence[InputLike],
         recipe: Recipe,
-        help:   str|None = None
+        help:   str|None = None,
+        restat: bool = False,
+        pool:   str | None = None,
+        batch:  int | None = None,
+        depfile: str | None = None
     ):
-        self.target = to_target(target)
+        # All outputs are made by one run of the recipe. The first one names the rule.
+        self.targets = to_targets(target)
+        self.target = self.targets[0]
         self.inputs = inputs
         self.recipe = recipe
         self.help =   help
 
+        # If set, the target is checked again after the recipe ran. If the
+        # recipe left it untouched, dependents are not considered outdated.
+        self.restat = restat
+
+        # The name of the pool limiting how many rules like this run at once.
+        self.pool = pool
+
+        # If set, the recipe runs once for every so many changed inputs, see Macher.execute.
+        self.batch = batch
+
+        # A file the recipe writes in Makefile syntax, listing further inputs, e.g. headers.
+        self.depfile = depfile
+
+        # The inputs as declared, if they contain globs, so they can be expanded again.
+        self.globbed = None
+
+        # The pattern rule this rule was cooked from, if any.
+        self.origin = None
+
+    def cook(self, targets: Sequence[Target], inputs: Sequence[InputLike]) -> Rule:
+        """Returns a copy of this rule for the given targets and inputs"""
+        rule = copy.copy(self)
+        rule.targets = list(targets)
+        rule.target = rule.targets[0]
+        rule.inputs = inputs
+        rule.origin = self
+        return rule
+
     @override
     def __str__(self):
         return self.target.name
@@ -143,12 +244,102 @@ class Rule:
     def matches(self, name: str) -> TargetMatch | None:
         return self.target.matches(name)
 
+    def get_names(self) -> list[str]:
+        return [ t.name for t in self.targets ]
+
+    def mark_done(self):
+        # Make each target only once
+        for t in self.targets:
+            t.done = True
+
+class _Trie:
+    children: dict[str, _Trie]
+    items: list
+
+    def __init__(self):
+        self.children = {}
+        self.items = []
+
+    def insert(self, key: Iterable[str]) -> _Trie:
+        node = self
+        for ch in key:
+            node = node.children.setdefault(ch, _Trie())
+
+        return node
+
+    def walk(self, key: Iterable[str]) -> Iterator[_Trie]:
+        """Yields the nodes along the given key, starting with the root"""
+        node = self
+        yield node
+
+        for ch in key:
+            child = node.children.get(ch)
+            if child is None:
+                return
+
+            node = child
+            yield node
+
+
+class PatternIndex:
+    """
+    Index of pattern rules by the literal prefix and suffix of their patterns.
+    Finding candidates for a name takes time proportional to the length of
+    the name, not to the number of patterns.
+    """
+
+    suffixes: _Trie
+    count: int
+
+    def __init__(self):
+        self.suffixes = _Trie()
+        self.count = 0
+
+    def add(self, rule: Rule):
+        """Indexes the given rule under each of its patterns"""
+        for target in rule.targets:
+            assert isinstance(target, Pattern)
+
+            node = self.suffixes.insert(reversed(target.suffix))
+            if not node.items:
+                node.items.append(_Trie())
+
+            prefixes: _Trie = node.items[0]
+            prefixes.insert(target.prefix).items.append( (self.count, rule, target) )
+
+        self.count += 1
+
+    def match(self, name: str) -> tuple[Rule, TargetMatch] | None:
+        """
+        Finds the most specific pattern rule matching the given name.
+        Of several equally specific rules, the one added first wins.
+        """
+        best = None
+        best_key = None
+
+        for snode in self.suffixes.walk(reversed(name)):
+            if not snode.items:
+                continue
+
+            for pnode in snode.items[0].walk(name):
+                for order, rule, target in pnode.items:
+                    key = ( -target.specificity(), order )
+                    if best_key is not None and key >= best_key:
+                        continue
+
+                    match = target.matches(name)
+                    if match is not None:
+                        best = ( rule, match )
+                        best_key = key
+
+        return best
+
+
 def is_file_name(name: str) -> bool:
     return "." in name or "/" in name
 
 def to_target(target: TargetLike) -> Target:
     # TODO: pattern target (use % or regex or glob)
-    # TODO: target group
     if isinstance(target, str):  # note that str is a Sequence
         if "%" in target:
             # if the name contains a percent, it's a pattern
@@ -160,3 +351,12 @@ def to_target(target: TargetLike) -> Target:
             return Target(target)
 
     return target
+
+def to_targets(targets: TargetLike | Sequence[TargetLike]) -> list[Target]:
+    if isinstance(targets, (str, Target)):
+        return [ to_target(targets) ]
+
+    if not targets:
+        raise ValueError("A rule needs at least one target")
+
+    return [ to_target(t) for t in targets ]
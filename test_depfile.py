@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from depfile import parse_depfile
+
+class DepfileTest(unittest.TestCase):
+    def test_parse(self):
+        text = (
+            "foo.o: foo.c include/foo.h \\\n"
+            "  include/bar.h # comment\n"
+            "include/foo.h:\n"
+            "include/bar.h:\n"
+        )
+
+        self.assertEqual(["foo.c", "include/foo.h", "include/bar.h"], parse_depfile(text))
+
+    def test_escapes(self):
+        text = "out/a\\ b.o: src/a\\ b.c price$$.h C:/inc/x.h\r\n"
+
+        self.assertEqual(["src/a b.c", "price$.h", "C:/inc/x.h"], parse_depfile(text))
+
+    def test_several_rules(self):
+        text = "a.o b.o: common.h\na.o: a.h common.h\n"
+
+        self.assertEqual(["common.h", "a.h"], parse_depfile(text))
+
+    def test_empty(self):
+        self.assertEqual([], parse_depfile(""))
+        self.assertEqual([], parse_depfile("foo.o:\n"))
+
+if __name__ == "__main__":
+    unittest.main()
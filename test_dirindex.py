@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+from dirindex import DirIndex
+from target import Glob
+
+class DirIndexTest(unittest.TestCase):
+    def write(self, *paths: str):
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(path)
+
+    def test_glob(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.write(*( os.path.join(tmp, name) for name in ("a.c", "b.h", ".x.c", "sub/c.c", "sub/deep/d.c", ".git/e.c") ))
+            index = DirIndex()
+
+            self.assertEqual([ f"{tmp}/a.c" ], index.glob(f"{tmp}/*.c"))
+            self.assertEqual([ f"{tmp}/a.c", f"{tmp}/sub/c.c", f"{tmp}/sub/deep/d.c" ], index.glob(f"{tmp}/**/*.c"))
+            self.assertEqual([ f"{tmp}/sub/c.c" ], index.glob(f"{tmp}/*/?.c"))
+            self.assertEqual([ f"{tmp}/.x.c" ], index.glob(f"{tmp}/.*.c"))
+            self.assertEqual([ f"{tmp}/b.h" ], index.glob(f"{tmp}/b.h"))
+            self.assertEqual([], index.glob(f"{tmp}/missing/*.c"))
+
+            dirs: set[str] = set()
+            index.glob(f"{tmp}/**/*.c", dirs)
+            self.assertEqual({ tmp, f"{tmp}/sub", f"{tmp}/sub/deep" }, dirs)
+
+    def test_refresh(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.write(os.path.join(tmp, "src", "a.c"))
+            src = os.path.join(tmp, "src")
+            os.utime(src, ns=(0, 1_000_000_000))
+
+            index = DirIndex(os.path.join(tmp, "dirs"))
+            self.assertEqual([ f"{src}/a.c" ], index.glob(f"{src}/*.c"))
+            index.save()
+
+            # A listing is only read again if the directory changed.
+            self.write(os.path.join(src, "b.c"))
+            os.utime(src, ns=(0, 1_000_000_000))
+            self.assertEqual([ f"{src}/a.c" ], DirIndex(os.path.join(tmp, "dirs")).glob(f"{src}/*.c"))
+
+            os.utime(src, ns=(0, 2_000_000_000))
+            self.assertEqual([ f"{src}/a.c", f"{src}/b.c" ], DirIndex(os.path.join(tmp, "dirs")).glob(f"{src}/*.c"))
+
+    def test_names(self):
+        glob = Glob("src/**/*.c", "build/%.o")
+
+        self.assertEqual(["build/a.o", "build/lib/b.o"], glob.names(["src/a.c", "src/lib/b.c"]))
+        self.assertEqual(["src/a.c"], Glob("src/*.c").names(["src/a.c"]))
+        self.assertEqual(["a-test"], Glob("t/[ab]*_test.py", "%-test").names(["t/a_test.py"]))
+
+if __name__ == "__main__":
+    unittest.main()
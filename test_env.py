@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import unittest
+
+from env import Environment, OutputMode
+
+class EnvironmentTest(unittest.TestCase):
+    def execute(self, env: Environment, script: str, **kwargs) -> tuple[int, str]:
+        out = io.StringIO()
+
+        with contextlib.redirect_stdout(out):
+            code = env.execute(script, OutputMode.DEFERRED, **kwargs)
+
+        return ( code, out.getvalue() )
+
+    def test_pool(self):
+        env = Environment()
+        env.use_pool(2)
+        self.addCleanup(env.use_pool, 0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = os.path.realpath(tmp)
+
+            code, out = self.execute(env, "echo $FOO; pwd; exit 3", envars={ "FOO": "it's" }, cwd=tmp)
+            self.assertEqual(3, code)
+            self.assertEqual(f"it's\n{tmp}\n", out)
+
+        # jobs don't leak state into each other
+        code, out = self.execute(env, "echo x$FOO; FOO=bar; cd /", envars={})
+        self.assertEqual(( 0, "x\n" ), ( code, out ))
+
+        code, out = self.execute(env, "echo x$FOO; printf partial", envars={})
+        self.assertEqual(( 0, "x\npartial" ), ( code, out ))
+
+        # a script that kills its shell fails, and the pool recovers
+        code, _ = self.execute(env, "kill $$", envars={})
+        self.assertNotEqual(0, code)
+
+        code, out = self.execute(env, "echo alive", envars={})
+        self.assertEqual(( 0, "alive\n" ), ( code, out ))
+
+    def test_pool_isolation(self):
+        env = Environment()
+        env.use_pool(1)
+        self.addCleanup(env.use_pool, 0)
+
+        # only the given variables reach the job, not our own environment
+        os.environ["MACH_TEST_LEAK"] = "leaked"
+        self.addCleanup(os.environ.pop, "MACH_TEST_LEAK")
+
+        code, out = self.execute(env, "echo x$MACH_TEST_LEAK", envars={ "FOO": "bar" })
+        self.assertEqual(( 0, "x\n" ), ( code, out ))
+
+        # a missing working directory fails the job instead of running it elsewhere
+        code, out = self.execute(env, "echo ran", envars={ "A": "1", "B": "2" }, cwd="/nonexistent/mach-test")
+        self.assertNotEqual(0, code)
+        self.assertNotIn("ran", out)
+
+    def test_concurrent_output(self):
+        env = Environment()
+        out = io.StringIO()
+        script = "for i in $(seq 200); do echo $1 $i; done; printf 'no newline'"
+
+        with contextlib.redirect_stdout(out):
+            threads = [
+                threading.Thread(target=env.execute, args=(script.replace("$1", f"job{n}"), OutputMode.DEFERRED))
+                for n in range(16)
+            ]
+
+            for t in threads:
+                t.start()
+
+            for t in threads:
+                t.join()
+
+        output = out.getvalue()
+        for n in range(16):
+            # deferred output of each job stays in one piece
+            block = "".join( f"job{n} {i}\n" for i in range(1, 201) ) + "no newline"
+            self.assertIn(block, output)
+
+    def test_broken_output(self):
+        env = Environment()
+
+        class Broken(io.StringIO):
+            def write(self, s):
+                raise BrokenPipeError()
+
+        with contextlib.redirect_stdout(Broken()):
+            code = env.execute("echo lost", OutputMode.LINES)
+
+        self.assertEqual(0, code)
+
+        # The output of later commands is still read.
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.execute(env, "echo ran")))
+        thread.start()
+        thread.join(10)
+
+        self.assertEqual([ (0, "ran\n") ], result)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import os
+import unittest
+
+from jobserver import Jobserver
+
+class JobserverTest(unittest.TestCase):
+    def test_tokens(self):
+        server = Jobserver.create(3)
+        self.addCleanup(server.close)
+
+        self.assertIsNone(server.acquire())  # the implicit slot
+        a = server.acquire()
+        b = server.acquire()
+        self.assertEqual(b"++", a + b)
+
+        # no tokens left
+        os.set_blocking(server.read_fd, False)
+        self.assertRaises(BlockingIOError, server.acquire)
+        os.set_blocking(server.read_fd, True)
+
+        server.release(a)
+        self.assertEqual(a, server.acquire())
+
+        server.release(None)
+        self.assertIsNone(server.acquire())
+
+    def test_try_acquire(self):
+        server = Jobserver.create(2)
+        self.addCleanup(server.close)
+
+        self.assertEqual(( True, None ), server.try_acquire())
+        self.assertEqual(( True, b"+" ), server.try_acquire())
+        self.assertEqual(( False, None ), server.try_acquire())
+
+        # the pipe itself is still blocking, for other processes
+        self.assertTrue(os.get_blocking(server.read_fd))
+
+        server.release(b"+")
+        self.assertEqual(( True, b"+" ), server.try_acquire())
+
+    def test_from_makeflags(self):
+        server = Jobserver.create(4)
+        self.addCleanup(server.close)
+
+        client = Jobserver.from_makeflags(" " + server.makeflags)
+        assert client is not None
+
+        self.assertEqual(4, client.limit)
+        self.assertEqual(( server.read_fd, server.write_fd ), client.pass_fds)
+
+        self.assertIsNone(Jobserver.from_makeflags("-k"))
+        self.assertIsNone(Jobserver.from_makeflags("-j4 --jobserver-auth=997,998"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,705 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from unittest import mock
+
+from macher import Macher
+from target import Glob, Pattern
+from scheduler import Scheduler
+from artifacts import ArtifactCache
+from hooks import Listener
+from env import OutputMode
+from wert import Context
+
+class Recorder:
+    """Collects the names of the targets made by recipes"""
+
+    def __init__(self, delay: float = 0.0):
+        self.made = []
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, ctx: Context):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+        time.sleep(self.delay)
+
+        with self.lock:
+            self.active -= 1
+            self.made.append(ctx["@"].name)
+
+def quiet_macher() -> Macher:
+    macher = Macher()
+    macher._log = lambda msg: None
+    macher.options["db"] = ""
+    return macher
+
+def quiet_script(macher: Macher, cmd: str):
+    script = macher.script(cmd)
+    script.echo = False
+    script.output = OutputMode.MUTE
+    return script
+
+class MacherTest(unittest.TestCase):
+    def test_parallel_jobs(self):
+        macher = quiet_macher()
+        rec = Recorder(0.05)
+
+        for name in ("a", "b", "c", "d"):
+            macher.add_rule(macher.make_rule(name, [], rec))
+
+        macher.add_rule(macher.make_rule("main", ["a", "b", "c", "d"], rec))
+
+        macher.process_argv(["mach", "--jobs=4"])
+        macher.mach(macher.require_rule("main"))
+
+        self.assertEqual("main", rec.made[-1])
+        self.assertEqual({"a", "b", "c", "d"}, set(rec.made[:-1]))
+        self.assertGreater(rec.max_active, 1)
+
+    def test_pool_depth(self):
+        macher = quiet_macher()
+        rec = Recorder(0.05)
+
+        for name in ("a", "b", "c", "d"):
+            macher.add_rule(macher.make_rule(name, [], rec, pool="link", depth=1))
+
+        macher.add_rule(macher.make_rule("main", ["a", "b", "c", "d"], rec))
+
+        macher.process_argv(["mach", "--jobs=4"])
+        macher.mach(macher.require_rule("main"))
+
+        self.assertEqual(5, len(rec.made))
+        self.assertEqual(1, rec.max_active)
+
+    def test_undeclared_pool(self):
+        macher = quiet_macher()
+        rec = Recorder()
+
+        self.assertRaises(ValueError, lambda: macher.make_rule("a", [], rec, depth=2))
+
+        macher.add_rule(macher.make_rule("main", [], rec, pool="nope"))
+        self.assertRaises(ValueError, lambda: macher.mach(macher.require_rule("main")))
+
+    def test_parallel_failure(self):
+        macher = quiet_macher()
+        rec = Recorder()
+
+        def fail(ctx: Context):
+            raise Exception("failed")
+
+        macher.add_rule(macher.make_rule("a", [], fail))
+        macher.add_rule(macher.make_rule("b", [], rec))
+        macher.add_rule(macher.make_rule("main", ["a", "b"], rec))
+
+        macher.process_argv(["mach", "--jobs=2"])
+        self.assertRaises(Exception, lambda: macher.mach(macher.require_rule("main")))
+        self.assertNotIn("main", rec.made)
+
+    def test_diamond(self):
+        macher = quiet_macher()
+        rec = Recorder()
+
+        macher.add_rule(macher.make_rule("base", [], rec))
+        macher.add_rule(macher.make_rule("left", ["base"], rec))
+        macher.add_rule(macher.make_rule("right", ["base"], rec))
+        macher.add_rule(macher.make_rule("main", ["left", "right"], rec))
+
+        plan = macher.plan(macher.require_rule("main"))
+        self.assertEqual(["base", "left", "right", "main"], [ r.get_name() for r in plan ])
+
+        macher.mach(macher.require_rule("main"))
+        self.assertEqual(["base", "left", "right", "main"], rec.made)
+
+    def test_deep_chain(self):
+        macher = quiet_macher()
+        rec = Recorder()
+
+        macher.add_rule(macher.make_rule("n0", [], rec))
+        for i in range(1, 2000):
+            macher.add_rule(macher.make_rule(f"n{i}", [f"n{i-1}"], rec))
+
+        macher.mach(macher.require_rule("n1999"))
+        self.assertEqual(2000, len(rec.made))
+
+    def test_critical_path_first(self):
+        def started(durations: dict[str, float]) -> list[str]:
+            macher = quiet_macher()
+
+            macher.add_rule(macher.make_rule("short", [], Recorder()))
+            macher.add_rule(macher.make_rule("c1", [], Recorder()))
+            macher.add_rule(macher.make_rule("c2", ["c1"], Recorder()))
+            macher.add_rule(macher.make_rule("main", ["short", "c2"], Recorder()))
+
+            for name, seconds in durations.items():
+                macher.db.record_duration(name, seconds)
+
+            scheduler = Scheduler(macher, 2)
+            scheduler._load(macher.require_rule("main"))
+            return [ str(rule) for rule, _ in scheduler._schedule() ]
+
+        # Without timings, the longer chain goes first.
+        self.assertEqual(["c1", "short"], started({}))
+
+        # A slow rule goes first, even if its path is shorter.
+        self.assertEqual(["short", "c1"], started({ "short": 10.0, "c1": 1.0, "c2": 1.0, "main": 1.0 }))
+
+    def test_declared_order(self):
+        macher = quiet_macher()
+        rec = Recorder()
+
+        macher.add_rule(macher.make_rule("a", [], rec))
+        macher.add_rule(macher.make_rule("c", [], rec))
+        macher.add_rule(macher.make_rule("b", ["c"], rec))
+        macher.add_rule(macher.make_rule("main", ["a", "b"], rec))
+
+        # With a single job, the longer chain doesn't go first.
+        macher.mach(macher.require_rule("main"))
+        self.assertEqual(["a", "c", "b", "main"], rec.made)
+        self.assertIsNotNone(macher.db.duration("c"))
+
+    def test_cycle(self):
+        macher = quiet_macher()
+
+        macher.add_rule(macher.make_rule("a", ["b"]))
+        macher.add_rule(macher.make_rule("b", ["c"]))
+        macher.add_rule(macher.make_rule("c", ["a"]))
+        macher.add_rule(macher.make_rule("main", ["a"]))
+
+        with self.assertRaises(ValueError) as cm:
+            macher.plan(macher.require_rule("main"))
+
+        self.assertIn("a -> b -> c -> a", str(cm.exception))
+
+    def test_find_rule(self):
+        macher = quiet_macher()
+
+        macher.add_rule(macher.make_rule("%.o", ["%.c"]))
+        macher.add_rule(macher.make_rule("lib/%.o", ["lib/%.cc"]))
+        macher.add_rule(macher.make_rule("lib/%.txt", ["lib/%.txt.in"]))
+        macher.add_rule(macher.make_rule("lib/special.o", ["x.c"]))
+
+        self.assertEqual(["x.c"], macher.find_rule("lib/special.o").inputs)
+        self.assertEqual(["lib/foo.cc"], macher.find_rule("lib/foo.o").inputs)
+        self.assertEqual(["foo.c"], macher.find_rule("foo.o").inputs)
+        self.assertEqual(["lib/foo.txt.in"], macher.find_rule("lib/foo.txt").inputs)
+        self.assertIsNone(macher.find_rule("fooxo"))
+
+        # cooked rules are re-used
+        self.assertIs(macher.find_rule("foo.o"), macher.find_rule("foo.o"))
+
+    def test_find_rule_many_patterns(self):
+        macher = quiet_macher()
+
+        for i in range(20000):
+            macher.add_rule(macher.make_rule(f"dir{i}/%.o", [f"dir{i}/%.c"]))
+
+        with mock.patch.object(Pattern, "matches", autospec=True, side_effect=Pattern.matches) as matches:
+            for i in range(0, 20000, 10):
+                matches.reset_mock()
+                self.assertIsNotNone(macher.find_rule(f"dir{i}/x.o"))
+
+                # Only the patterns sharing the name's prefix are tried.
+                self.assertLessEqual(matches.call_count, 2)
+
+    def test_build_db(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "in.txt")
+            out = os.path.join(tmp, "out.txt")
+
+            with open(src, "w") as f:
+                f.write("test")
+
+            def build(flag: str) -> list[str]:
+                macher = quiet_macher()
+                macher.options["db"] = os.path.join(tmp, "db")
+                macher.set_var("FLAG", flag)
+
+                rec = Recorder()
+                recipe = [ quiet_script(macher, "cp $< $@ # $(FLAG)"), rec ]
+                macher.add_rule(macher.make_rule(out, [src], recipe))
+                macher.mach(macher.require_rule(out))
+                return rec.made
+
+            self.assertEqual([out], build("-O1"))
+            self.assertEqual([], build("-O1"))
+            self.assertEqual([out], build("-O2"))
+            self.assertEqual([], build("-O2"))
+
+            # a changed input is detected even if it isn't newer
+            with open(src, "w") as f:
+                f.write("changed")
+
+            os.utime(src, (0, 0))
+            self.assertEqual([out], build("-O2"))
+
+    def test_artifact_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "in.txt")
+            out = os.path.join(tmp, "out.txt")
+            runs = os.path.join(tmp, "runs")
+
+            with open(src, "w") as f:
+                f.write("test")
+
+            def build() -> list[str]:
+                macher = quiet_macher()
+                macher.options["cache"] = os.path.join(tmp, "cache")
+
+                hits = []
+                class Hits(Listener):
+                    def cache_hit(self, rule):
+                        hits.append(str(rule))
+
+                macher.add_listener(Hits())
+                macher.add_rule(macher.make_rule(out, [src], quiet_script(macher, f"cp $< $@; echo x >> {runs}")))
+                macher.mach(macher.require_rule(out))
+                return hits
+
+            def count() -> int:
+                with open(runs) as f:
+                    return len(f.readlines())
+
+            self.assertEqual([], build())
+            self.assertEqual(1, count())
+
+            # e.g. after switching branches
+            os.unlink(out)
+            self.assertEqual([out], build())
+            self.assertEqual(1, count())
+
+            with open(out) as f:
+                self.assertEqual("test", f.read())
+
+            with open(src, "w") as f:
+                f.write("changed")
+
+            self.assertEqual([], build())
+            self.assertEqual(2, count())
+
+    def test_artifact_cache_trim(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for i in range(3):
+                paths.append(os.path.join(tmp, f"out{i}.txt"))
+                with open(paths[-1], "w") as f:
+                    f.write(str(i) * 1000)
+
+            cache = ArtifactCache(os.path.join(tmp, "cache"), 2500)
+
+            with mock.patch("artifacts.os.walk", wraps=os.walk) as walk:
+                # The first trim counts what is there.
+                cache.trim()
+                self.assertEqual(1, walk.call_count)
+
+                # Below the limit, the total we kept is enough.
+                cache.store("a" * 64, paths[:1])
+                cache.trim()
+                self.assertEqual(1, walk.call_count)
+
+                # Another process sharing the cache knows the total too.
+                cache = ArtifactCache(os.path.join(tmp, "cache"), 2500)
+                cache.store("b" * 64, paths[1:])
+                cache.trim()
+                self.assertEqual(2, walk.call_count)
+
+            self.assertLessEqual(cache.total, 2500)
+            self.assertFalse(cache.restore("a" * 64, paths[:1]))
+            self.assertTrue(cache.restore("b" * 64, paths[1:]))
+
+    def test_graph_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            def define(extra: list[str] = []) -> tuple[Macher, Recorder]:
+                macher = quiet_macher()
+                macher.options["db"] = os.path.join(tmp, "db")
+                macher.machfile_key = "test"
+
+                rec = Recorder()
+                macher.add_rule(macher.make_rule("%.o", ["%.c"], rec))
+                macher.add_rule(macher.make_rule("main", ["a.o", "b.o"] + extra, rec))
+                return macher, rec
+
+            macher, rec = define()
+            macher.mach(macher.require_rule("main"))
+            self.assertEqual(["a.o", "b.o", "main"], rec.made)
+
+            # The graph is restored without matching patterns.
+            macher, rec = define()
+            macher.patterns.match = None
+            macher.mach(macher.require_rule("main"))
+            self.assertEqual(["a.o", "b.o", "main"], rec.made)
+            self.assertIs(macher.rules_by_name["%.o"], macher.require_rule("a.o").origin)
+
+            # Changed rules invalidate the snapshot.
+            macher, rec = define(["c.o"])
+            macher.mach(macher.require_rule("main"))
+            self.assertEqual(["a.o", "b.o", "c.o", "main"], rec.made)
+
+    def test_multiple_targets(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            def build() -> list[str]:
+                macher = quiet_macher()
+                macher.options["db"] = os.path.join(tmp, "db")
+
+                rec = Recorder()
+                gen = [ quiet_script(macher, "touch $(__targets__)"), rec ]
+                macher.add_rule(macher.make_rule([ f"{tmp}/%.h", f"{tmp}/%.cc" ], [ f"{tmp}/%.proto" ], gen))
+                macher.add_rule(macher.make_rule(f"{tmp}/x.proto"))
+
+                main = [ quiet_script(macher, f"echo $^ > {tmp}/inputs"), rec ]
+                macher.add_rule(macher.make_rule("main", [ f"{tmp}/x.cc", f"{tmp}/x.h" ], main))
+                macher.mach(macher.require_rule("main"))
+                return [ os.path.basename(name) for name in rec.made ]
+
+            with open(f"{tmp}/x.proto", "w") as f:
+                f.write("message X {}")
+
+            # one run of the generator makes both outputs
+            self.assertEqual(["x.h", "main"], build())
+            self.assertTrue(os.path.exists(f"{tmp}/x.cc"))
+
+            with open(f"{tmp}/inputs") as f:
+                self.assertEqual(f"{tmp}/x.cc {tmp}/x.h", f.read().strip())
+
+            self.assertEqual(["main"], build())
+
+            # any missing output means the rule has to run again
+            os.unlink(f"{tmp}/x.cc")
+            self.assertEqual(["x.h", "main"], build())
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sources = [ os.path.join(tmp, f"{i}.c") for i in range(5) ]
+            stamp = os.path.join(tmp, "lint.stamp")
+
+            for src in sources:
+                with open(src, "w") as f:
+                    f.write(src)
+
+            def build() -> list[list[str]]:
+                macher = quiet_macher()
+                batches = []
+                lock = threading.Lock()
+
+                def lint(ctx: Context):
+                    with lock:
+                        batches.append(sorted( os.path.basename(name) for name in ctx["?"] ))
+
+                    with open(stamp, "a"):
+                        pass
+
+                macher.add_rule(macher.make_rule(stamp, sources, lint, batch=2))
+                macher.process_argv(["mach", "--jobs=2"])
+                macher.mach(macher.require_rule(stamp))
+                return sorted(batches)
+
+            self.assertEqual([ ["0.c", "1.c"], ["2.c", "3.c"], ["4.c"] ], build())
+            self.assertEqual([], build())
+
+            # only what changed since the stamp was made
+            later = time.time() + 10
+            os.utime(sources[3], (later, later))
+            self.assertEqual([ ["3.c"] ], build())
+
+    def test_concurrent_batches(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            macher = quiet_macher()
+            macher.process_argv(["mach", "--jobs=2"])
+            chunks = []
+
+            def lint(ctx: Context):
+                time.sleep(0.01)
+                chunks.append(list(ctx["?"]))
+
+            for name in ("a", "b"):
+                sources = [ os.path.join(tmp, f"{name}{i}.c") for i in range(4) ]
+                for src in sources:
+                    with open(src, "w") as f:
+                        f.write(src)
+
+                macher.add_rule(macher.make_rule(f"lint_{name}", sources, lint, batch=1))
+
+            macher.add_rule(macher.make_rule("main", ["lint_a", "lint_b"]))
+
+            # Each rule holds a job slot while running its chunks, neither may wait for the other's.
+            thread = threading.Thread(target=macher.mach, args=(macher.require_rule("main"),), daemon=True)
+            thread.start()
+            thread.join(10)
+
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(8, len(chunks))
+
+    def test_depfile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "a.c")
+            header = os.path.join(tmp, "a.h")
+            out = os.path.join(tmp, "a.o")
+
+            for path in (src, header):
+                with open(path, "w") as f:
+                    f.write(path)
+
+            def compile(ctx: Context):
+                # like cc -MD, the header isn't known to the Machfile
+                with open(ctx["@"].name, "w") as f:
+                    f.write("compiled")
+
+                with open(ctx["@"].name[:-2] + ".d", "w") as f:
+                    f.write(f"{ctx['@'].name}: {ctx['<']} \\\n {header}\n{header}:\n")
+
+            def build() -> list[str]:
+                macher = quiet_macher()
+                macher.options["db"] = os.path.join(tmp, "db")
+
+                rec = Recorder()
+                rule = macher.make_rule(os.path.join(tmp, "%.o"), [ os.path.join(tmp, "%.c") ], [ compile, rec ], depfile=os.path.join(tmp, "%.d"))
+                macher.add_rule(rule)
+                macher.mach(macher.require_rule(out))
+                return rec.made
+
+            self.assertEqual([out], build())
+            self.assertEqual([], build())
+
+            with open(header, "w") as f:
+                f.write("changed")
+
+            self.assertEqual([out], build())
+            self.assertEqual([], build())
+
+    def test_glob(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "src")
+
+            def write(name: str):
+                os.makedirs(os.path.dirname(name), exist_ok=True)
+                with open(name, "w") as f:
+                    f.write(name)
+
+            def compile(ctx: Context):
+                write(ctx["@"].name)
+
+            def build() -> list[str]:
+                macher = quiet_macher()
+                macher.options["db"] = os.path.join(tmp, ".mach", "db")
+                macher.machfile_key = "test"
+
+                linked = []
+                objects = Glob(f"{src}/**/*.c", f"{tmp}/build/%.o")
+                macher.add_rule(macher.make_rule(f"{tmp}/build/%.o", [ f"{src}/%.c" ], compile))
+                macher.add_rule(macher.make_rule("main", [ objects ], lambda ctx: linked.extend(ctx["^"])))
+                macher.mach(macher.require_rule("main"))
+                return [ os.path.relpath(name, tmp) for name in linked ]
+
+            write(f"{src}/a.c")
+            write(f"{src}/lib/b.c")
+            self.assertEqual(["build/a.o", "build/lib/b.o"], build())
+            self.assertTrue(os.path.exists(f"{tmp}/build/lib/b.o"))
+
+            # New files are picked up, even though the graph was snapshotted.
+            write(f"{src}/lib/c.c")
+            self.assertEqual(["build/a.o", "build/lib/b.o", "build/lib/c.o"], build())
+
+    def test_early_cutoff(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "in.txt")
+            gen = os.path.join(tmp, "gen.txt")
+            out = os.path.join(tmp, "out.txt")
+
+            def build(content: str) -> list[str]:
+                with open(src, "w") as f:
+                    f.write(content)
+
+                macher = quiet_macher()
+                macher.options["db"] = os.path.join(tmp, "db")
+
+                rec = Recorder()
+                generate = [ quiet_script(macher, "cut -c1 $< > $@"), rec ]
+                macher.add_rule(macher.make_rule(gen, [src], generate, hashed=True))
+                macher.add_rule(macher.make_rule(out, [gen], [ quiet_script(macher, "cp $< $@"), rec ]))
+                macher.mach(macher.require_rule(out))
+                return rec.made
+
+            self.assertEqual([gen, out], build("abc"))
+            self.assertEqual([gen], build("axx"))
+            self.assertEqual([gen, out], build("xyz"))
+
+    def test_restat(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "in.txt")
+            gen = os.path.join(tmp, "gen.txt")
+            out = os.path.join(tmp, "out.txt")
+
+            def build(content: str, restat: bool) -> list[str]:
+                with open(src, "w") as f:
+                    f.write(content)
+
+                macher = quiet_macher()
+                macher.options["db"] = os.path.join(tmp, "db")
+
+                rec = Recorder()
+                generate = [ quiet_script(macher, "cut -c1 $< > $@.new; cmp -s $@.new $@ || mv $@.new $@"), rec ]
+                macher.add_rule(macher.make_rule(gen, [src], generate, restat=restat))
+                macher.add_rule(macher.make_rule(out, [gen], [ quiet_script(macher, "cp $< $@"), rec ]))
+                macher.mach(macher.require_rule(out))
+                return rec.made
+
+            self.assertEqual([gen, out], build("abc", True))
+            self.assertEqual([gen], build("axx", True))
+            self.assertEqual([gen, out], build("xyz", True))
+            self.assertEqual([gen, out], build("xzz", False))
+
+    def test_async_engine(self):
+        macher = quiet_macher()
+        rec = Recorder()
+
+        for name in ("a", "b", "c", "d"):
+            macher.add_rule(macher.make_rule(name, [], quiet_script(macher, "sleep 0.2")))
+
+        macher.add_rule(macher.make_rule("main", ["a", "b", "c", "d"], rec))
+        macher.process_argv(["mach", "--jobs=4"])
+
+        async def build():
+            # the event loop stays responsive while the build runs
+            ticks = 0
+            task = asyncio.create_task(macher.amach(macher.require_rule("main")))
+
+            while not task.done():
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+            await task
+            return ticks
+
+        start = time.perf_counter()
+        ticks = asyncio.run(build())
+
+        self.assertLess(time.perf_counter() - start, 0.6)
+        self.assertGreater(ticks, 5)
+        self.assertEqual(["main"], rec.made)
+
+    def test_isolate_process(self):
+        macher = quiet_macher()
+        macher.set_var("parent", os.getpid())
+
+        def child(ctx: Context):
+            ctx.export("child", ( ctx["parent"], os.getpid(), ctx["@"].name ))
+
+        macher.add_rule(macher.make_rule("main", [], child, isolate="process"))
+        macher.mach(macher.require_rule("main"))
+
+        parent, pid, target = macher.context["child"]
+        self.assertEqual(os.getpid(), parent)
+        self.assertNotEqual(os.getpid(), pid)
+        self.assertEqual("main", target)
+
+        # The workers only live as long as the build.
+        self.assertIsNone(macher.workers)
+
+    def test_trace(self):
+        macher = quiet_macher()
+        rec = Recorder(0.02)
+
+        macher.add_rule(macher.make_rule("a", [], rec))
+        macher.add_rule(macher.make_rule("b", [], rec))
+        macher.add_rule(macher.make_rule("fail", ["a", "b"], quiet_script(macher, "exit 3")))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.json")
+            macher.process_argv(["mach", "--jobs=2", f"--trace={path}"])
+
+            self.assertRaises(Exception, lambda: macher.mach(macher.require_rule("fail")))
+
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+
+        recipes = { e["name"]: e for e in events if e.get("cat") == "recipe" }
+        self.assertEqual({"a", "b", "fail"}, set(recipes))
+        self.assertEqual({1, 2}, { recipes["a"]["tid"], recipes["b"]["tid"] })
+        self.assertEqual("python", recipes["a"]["args"]["recipe"])
+        self.assertEqual("script", recipes["fail"]["args"]["recipe"])
+        self.assertEqual(3, recipes["fail"]["args"]["exit_code"])
+
+        checks = [ e for e in events if e.get("cat") == "check" ]
+        self.assertEqual(3, len(checks))
+        self.assertTrue(all( c["args"]["outdated"] for c in checks ))
+
+    def test_trace_several_targets(self):
+        macher = quiet_macher()
+        rec = Recorder()
+
+        macher.add_rule(macher.make_rule("a", [], rec))
+        macher.add_rule(macher.make_rule("b", [], rec))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.json")
+            macher.process_argv(["mach", f"--trace={path}"])
+
+            # like "mach a b": one build per target, one trace for all
+            macher.mach(macher.require_rule("a"))
+            macher.mach(macher.require_rule("b"))
+
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+
+        self.assertEqual(["a", "b"], [ e["name"] for e in events if e.get("cat") == "recipe" ])
+
+    def test_listener(self):
+        macher = quiet_macher()
+        events = []
+
+        class Events(Listener):
+            def rule_checked(self, rule, reason):
+                events.append( ( "checked", str(rule), reason is not None ) )
+
+            def recipe_finished(self, rule, seconds, code, error):
+                events.append( ( "finished", str(rule), code ) )
+
+            def script_finished(self, cmd, seconds, code):
+                events.append( ( "script", cmd, code ) )
+
+            def build_finished(self, rule, error):
+                events.append( ( "build", str(rule), error is None ) )
+
+        macher.add_listener(Events())
+        macher.add_rule(macher.make_rule("a", [], Recorder()))
+        macher.add_rule(macher.make_rule("main", ["a"], quiet_script(macher, "true")))
+        macher.mach(macher.require_rule("main"))
+
+        self.assertEqual([
+            ( "checked", "a", True ),
+            ( "finished", "a", None ),
+            ( "checked", "main", True ),
+            ( "script", "true", 0 ),
+            ( "finished", "main", 0 ),
+            ( "build", "main", True ),
+        ], events)
+
+    def test_bad_jobs(self):
+        macher = quiet_macher()
+        macher.process_argv(["mach", "--jobs=x"])
+        self.assertRaises(ValueError, macher.jobs)
+
+    def test_throttle(self):
+        macher = quiet_macher()
+        macher.process_argv(["mach", "--maxload=1000", "--minmem=0"])
+
+        throttle = macher.throttle()
+        self.assertTrue(throttle)
+        self.assertIsNone(throttle.blocked())
+
+        macher.process_argv(["mach", "--maxload=x"])
+        self.assertRaises(ValueError, macher.throttle)
+
+if __name__ == "__main__":
+    unittest.main()
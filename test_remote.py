@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from artifacts import ArtifactCache
+from remote import RemoteCache, serve
+
+class RemoteTest(unittest.TestCase):
+    def start_server(self, root: str) -> RemoteCache:
+        server = serve(root)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        remote = RemoteCache(f"http://127.0.0.1:{server.server_address[1]}")
+        self.addCleanup(remote.close)
+        return remote
+
+    def test_protocol(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            remote = self.start_server(os.path.join(tmp, "server"))
+
+            path = os.path.join(tmp, "blob")
+            with open(path, "wb") as f:
+                f.write(b"content")
+
+            digest = hashlib.sha256(b"content").hexdigest()
+            self.assertFalse(remote.has("cas", digest))
+            self.assertTrue(remote.put("cas", digest, path))
+            self.assertTrue(remote.has("cas", digest))
+
+            # content that doesn't match the digest is refused
+            self.assertFalse(remote.put("cas", "0" * 64, path))
+            self.assertFalse(remote.has("cas", "0" * 64))
+
+            copy = os.path.join(tmp, "copy")
+            self.assertTrue(remote.get("cas", digest, copy))
+            with open(copy, "rb") as f:
+                self.assertEqual(b"content", f.read())
+
+            self.assertFalse(remote.get("ac", "1" * 64, copy))
+
+    def test_shared_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            remote = self.start_server(os.path.join(tmp, "server"))
+
+            out = os.path.join(tmp, "out.txt")
+            with open(out, "w") as f:
+                f.write("made")
+
+            key = "a" * 64
+            here = ArtifactCache(os.path.join(tmp, "here"), 1 << 20, remote)
+            here.store(key, [ out ])
+            here.flush()
+
+            # another machine, with an empty local cache
+            os.unlink(out)
+            there = ArtifactCache(os.path.join(tmp, "there"), 1 << 20, remote)
+            there.prefetch(key)
+            self.assertTrue(there.restore(key, [ out ]))
+
+            with open(out) as f:
+                self.assertEqual("made", f.read())
+
+            self.assertFalse(there.restore("b" * 64, [ out ]))
+
+    def test_untrusted_records(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = os.path.join(tmp, "server")
+            remote = self.start_server(root)
+            cache = ArtifactCache(os.path.join(tmp, "cache"), 1 << 20, remote)
+
+            out = os.path.join(tmp, "out.txt")
+            evil = os.path.join(tmp, "evil.txt")
+            digest = hashlib.sha256(b"content").hexdigest()
+
+            def publish(key: str, record: dict):
+                path = os.path.join(tmp, "record")
+                with open(path, "w") as f:
+                    json.dump(record, f)
+
+                self.assertTrue(remote.put("ac", key, path))
+
+            # an object that doesn't match its digest, e.g. corrupted on the server
+            os.makedirs(os.path.join(root, "cas", digest[:2]))
+            with open(os.path.join(root, "cas", digest[:2], digest), "wb") as f:
+                f.write(b"tampered")
+
+            publish("a" * 64, { out: { "digest": digest, "mode": 0o644 } })
+            publish("b" * 64, { evil: { "digest": digest, "mode": 0o644 } })
+            publish("c" * 64, { out: { "digest": "../../../record", "mode": 0o644 } })
+
+            for key in ("a" * 64, "b" * 64, "c" * 64):
+                self.assertFalse(cache.restore(key, [ out ]))
+
+            self.assertFalse(os.path.exists(out))
+            self.assertFalse(os.path.exists(evil))
+
+    def test_unreachable(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            remote = RemoteCache("http://127.0.0.1:9", timeout=1.0)
+            self.addCleanup(remote.close)
+
+            cache = ArtifactCache(os.path.join(tmp, "cache"), 1 << 20, remote)
+            self.assertFalse(cache.restore("a" * 64, [ "out.txt" ]))
+
+if __name__ == "__main__":
+    unittest.main()
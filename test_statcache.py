@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+from statcache import StatCache
+
+class StatCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "file.txt")
+
+        with open(self.path, "w") as f:
+            f.write("test")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_stat_once(self):
+        self.check_stat_once(StatCache())
+
+    def test_stat_once_scan_dirs(self):
+        self.check_stat_once(StatCache(True))
+
+    def check_stat_once(self, stats: StatCache):
+        missing = os.path.join(self.tmp.name, "missing.txt")
+
+        self.assertEqual(os.path.getmtime(self.path), stats.mtime(self.path))
+        self.assertIsNone(stats.stat(missing))
+
+        os.unlink(self.path)
+        self.assertIsNotNone(stats.stat(self.path))
+
+        stats.invalidate(self.path)
+        self.assertIsNone(stats.stat(self.path))
+
+        with open(missing, "w") as f:
+            f.write("test")
+
+        self.assertIsNone(stats.stat(missing))
+        stats.invalidate(missing)
+        self.assertIsNotNone(stats.stat(missing))
+
+    def test_scan_dirs(self):
+        stats = StatCache(True)
+        stats.stat(self.path)
+
+        self.assertIn(self.tmp.name, stats._dirs)
+        self.assertIn("file.txt", stats._dirs[self.tmp.name])
+
+    def test_invalidate_keeps_listing(self):
+        stats = StatCache(True)
+        other = os.path.join(self.tmp.name, "other.txt")
+        stats.stat(self.path)
+
+        with open(other, "w") as f:
+            f.write("new")
+
+        # Writing one output doesn't mean listing the directory again.
+        stats.invalidate(other)
+        listing = stats._dirs[self.tmp.name]
+        self.assertIsNotNone(stats.stat(other))
+        self.assertIs(listing, stats._dirs[self.tmp.name])
+        self.assertIsNone(stats.stat(os.path.join(self.tmp.name, "missing.txt")))
+
+if __name__ == "__main__":
+    unittest.main()
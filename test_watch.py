@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from hooks import Listener
+from target import Glob
+from test_macher import quiet_macher, quiet_script
+from watch import Inotify, Watcher
+
+class WatchTest(unittest.TestCase):
+    def test_inotify(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            inotify = Inotify()
+            self.addCleanup(inotify.close)
+
+            inotify.watch(tmp)
+            self.assertEqual(set(), inotify.read(0))
+
+            path = os.path.join(tmp, "a.txt")
+            with open(path, "w") as f:
+                f.write("a")
+
+            self.assertIn(path, inotify.read(1.0))
+
+    def test_rebuild_affected(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            macher = quiet_macher()
+            made = []
+            builds = []
+
+            class Made(Listener):
+                def recipe_finished(self, rule, seconds, code, error):
+                    made.append(os.path.basename(str(rule)))
+
+                def build_finished(self, rule, error):
+                    builds.append(list(made))
+                    made.clear()
+
+            macher.add_listener(Made())
+
+            sources = {}
+            for name in ("a", "b"):
+                sources[name] = os.path.join(tmp, f"{name}.c")
+                with open(sources[name], "w") as f:
+                    f.write(name)
+
+                out = os.path.join(tmp, f"{name}.o")
+                macher.add_rule(macher.make_rule(out, [sources[name]], quiet_script(macher, "cp $< $@")))
+
+            objects = [ os.path.join(tmp, "a.o"), os.path.join(tmp, "b.o") ]
+            macher.add_rule(macher.make_rule("main", objects, lambda ctx: None))
+
+            watcher = Watcher(macher, [ macher.require_rule("main") ], settle=0.05)
+            thread = threading.Thread(target=watcher.run, args=(lambda: len(builds) >= 2,), daemon=True)
+            thread.start()
+
+            deadline = time.monotonic() + 10
+            while not builds and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            self.assertEqual(["a.o", "b.o", "main"], sorted(builds[0]))
+
+            # Let the watcher get to waiting, then change one input.
+            time.sleep(0.2)
+            with open(sources["a"], "w") as f:
+                f.write("changed")
+
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(["a.o", "main"], sorted(builds[1]))
+
+    def test_missing_directory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            macher = quiet_macher()
+            builds = []
+
+            class Builds(Listener):
+                def build_finished(self, rule, error):
+                    builds.append(error)
+
+            macher.add_listener(Builds())
+
+            src = os.path.join(tmp, "in.txt")
+            out = os.path.join(tmp, "build", "out.txt")
+            with open(src, "w") as f:
+                f.write("bad")
+
+            def make(ctx):
+                with open(src) as f:
+                    content = f.read()
+
+                if content == "bad":
+                    raise Exception("can't make this")
+
+                os.makedirs(os.path.dirname(out), exist_ok=True)
+                with open(out, "w") as f:
+                    f.write(content)
+
+            macher.add_rule(macher.make_rule(out, [src], make))
+
+            # The first build fails before creating the directory of the target.
+            watcher = Watcher(macher, [ macher.require_rule(out) ], settle=0.05)
+            thread = threading.Thread(target=watcher.run, args=(lambda: len(builds) >= 2,), daemon=True)
+            thread.start()
+
+            deadline = time.monotonic() + 10
+            while not builds and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            self.assertIsNotNone(builds[0])
+
+            time.sleep(0.2)
+            self.assertTrue(thread.is_alive())
+            with open(src, "w") as f:
+                f.write("good")
+
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+            self.assertIsNone(builds[1])
+
+            with open(out) as f:
+                self.assertEqual("good", f.read())
+
+    def test_new_file_in_glob(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            macher = quiet_macher()
+            linked = []
+
+            src = os.path.join(tmp, "src")
+            os.makedirs(os.path.join(src, "lib"))
+            with open(os.path.join(src, "a.c"), "w") as f:
+                f.write("a")
+
+            def link(ctx):
+                linked.append([ os.path.relpath(name, src) for name in ctx["^"] ])
+
+            macher.add_rule(macher.make_rule("main", [ Glob(f"{src}/**/*.c") ], link))
+
+            watcher = Watcher(macher, [ macher.require_rule("main") ], settle=0.05)
+            thread = threading.Thread(target=watcher.run, args=(lambda: len(linked) >= 2,), daemon=True)
+            thread.start()
+
+            deadline = time.monotonic() + 10
+            while not linked and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            self.assertEqual([ "a.c" ], linked[0])
+
+            # A new file in a subdirectory the glob covers.
+            time.sleep(0.2)
+            with open(os.path.join(src, "lib", "b.c"), "w") as f:
+                f.write("b")
+
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual([ "a.c", "lib/b.c" ], linked[1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -80,5 +80,15 @@ class WertTest(unittest.TestCase):
         else:
             self.assertRaises(expected, lambda: wert.expand_all(cmd, ctx))
 
+    def test_compile_template(self):
+        template = wert.compile_template("cc $(flags) -o $@ $<")
+        self.assertIs(template, wert.compile_template("cc $(flags) -o $@ $<"))
+
+        ctx = wert.Context({ "flags": "-O2", "@": "a.o", "<": "a.c" })
+        self.assertEqual("cc -O2 -o a.o a.c", template.render(ctx))
+
+        ctx = wert.Context({ "flags": [ "-g", "-O0" ], "@": "b.o", "<": "b.c" })
+        self.assertEqual("cc -g -O0 -o b.o b.c", template.render(ctx))
+
 if __name__ == "__main__":
     unittest.main()
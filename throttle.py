@@ -0,0 +1,67 @@
+import time
+
+_LOADAVG = "/proc/loadavg"
+_MEMINFO = "/proc/meminfo"
+
+def load_average() -> float | None:
+    """The system's load average over the last minute, None if unknown"""
+    try:
+        with open(_LOADAVG) as f:
+            return float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+def free_memory() -> float | None:
+    """The memory available for new processes in MB, None if unknown"""
+    try:
+        with open(_MEMINFO) as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return None
+
+class Throttle:
+    """
+    Holds back new jobs while the system is overloaded: while the load average
+    is above max_load, or less than min_free_mem MB of memory is available.
+    Readings are taken at most once per interval.
+    """
+
+    max_load: float | None
+    min_free_mem: float | None
+    interval: float
+
+    def __init__(self, max_load: float | None = None, min_free_mem: float | None = None, interval: float = 0.5):
+        self.max_load = max_load
+        self.min_free_mem = min_free_mem
+        self.interval = interval
+
+        self._checked = 0.0
+        self._reason: str | None = None
+
+    def __bool__(self) -> bool:
+        return self.max_load is not None or self.min_free_mem is not None
+
+    def blocked(self) -> str | None:
+        """Returns why no new jobs should be started now, or None if they can be"""
+        now = time.monotonic()
+        if now - self._checked < self.interval:
+            return self._reason
+
+        self._checked = now
+        self._reason = None
+
+        if self.max_load is not None:
+            load = load_average()
+            if load is not None and load > self.max_load:
+                self._reason = f"load average is {load:.2f}"
+
+        if self.min_free_mem is not None:
+            free = free_memory()
+            if free is not None and free < self.min_free_mem:
+                self._reason = f"only {free:.0f} MB of memory available"
+
+        return self._reason
@@ -0,0 +1,106 @@
+import heapq
+import json
+import os
+import time
+
+from typing import Any
+
+from isolate import Isolated
+from recipe import Recipe, Script, Steps, exit_code
+from target import Rule
+
+def recipe_type(recipe: Recipe) -> str:
+    """A short name for the kind of the given recipe"""
+    if isinstance(recipe, Script):
+        return "script"
+
+    if isinstance(recipe, Steps):
+        return "steps"
+
+    if isinstance(recipe, Isolated):
+        return "process"
+
+    return "python"
+
+class Tracer:
+    """
+    Records when each rule was checked and made, and writes it as a Chrome
+    trace event file that can be opened in Perfetto or chrome://tracing.
+    Checks are shown on the scheduler's track, recipes on the track of the
+    job slot they ran in. Slots are numbered from 1, and a recipe always
+    gets the lowest free slot, so the number of tracks shows how many jobs
+    were actually busy.
+    """
+
+    path: str
+    events: list[dict[str, Any]]
+    started: dict[Rule, tuple[float, int, str | None]]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.events = []
+        self.started = {}
+        self.free: list[int] = []
+        self.slots = 0
+        self.origin = time.perf_counter()
+
+    def now(self) -> float:
+        """Microseconds since tracing started"""
+        return ( time.perf_counter() - self.origin ) * 1e6
+
+    def check(self, rule: Rule, start: float, reason: str | None):
+        """Records an outdatedness check that started at the given time"""
+        self.events.append({
+            "name": f"check {rule}",
+            "cat": "check",
+            "ph": "X",
+            "ts": start,
+            "dur": self.now() - start,
+            "pid": 1,
+            "tid": 0,
+            "args": { "outdated": reason is not None, "reason": reason },
+        })
+
+    def start(self, rule: Rule, reason: str | None):
+        if self.free:
+            slot = heapq.heappop(self.free)
+        else:
+            self.slots += 1
+            slot = self.slots
+
+        self.started[rule] = ( self.now(), slot, reason )
+
+    def end(self, rule: Rule, exc: BaseException | None):
+        start, slot, reason = self.started.pop(rule)
+        heapq.heappush(self.free, slot)
+
+        self.events.append({
+            "name": str(rule),
+            "cat": "recipe",
+            "ph": "X",
+            "ts": start,
+            "dur": self.now() - start,
+            "pid": 1,
+            "tid": slot,
+            "args": {
+                "reason": reason,
+                "recipe": recipe_type(rule.recipe),
+                "exit_code": exit_code(rule.recipe, exc),
+                "error": None if exc is None else str(exc),
+            },
+        })
+
+    def save(self):
+        names = [ ( 0, "scheduler" ) ] + [ ( slot, f"slot {slot}" ) for slot in range(1, self.slots + 1) ]
+        meta = [
+            { "name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": { "name": name } }
+            for tid, name in names
+        ]
+        meta.append({ "name": "process_name", "ph": "M", "pid": 1, "tid": 0, "args": { "name": "mach" } })
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({ "traceEvents": meta + self.events, "displayTimeUnit": "ms" }, f)
@@ -0,0 +1,266 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from typing import Callable
+
+from target import File, Rule
+
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_CLOEXEC = 0o2000000
+
+_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT = struct.Struct("iIII")
+
+class Inotify:
+    """
+    Watches directories for changes using Linux inotify, through ctypes.
+    Directories are watched rather than files, so files replaced by a
+    rename, as many editors do, are noticed as well.
+    """
+
+    fd: int
+    dirs: dict[int, str]
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self.dirs = {}
+        self.watched: set[str] = set()
+
+    def watch(self, directory: str):
+        if directory in self.watched:
+            return
+
+        wd = self.add_watch(self.fd, os.fsencode(directory), _MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+
+        self.dirs[wd] = directory
+        self.watched.add(directory)
+
+    def read(self, timeout: float | None = None) -> set[str] | None:
+        """
+        Waits for changes, and returns the paths that changed. Returns an
+        empty set after the timeout, or None if events were lost.
+        """
+        ready, _, _ = select.select([ self.fd ], [], [], timeout)
+        if not ready:
+            return set()
+
+        data = os.read(self.fd, 65536)
+        paths: set[str] = set()
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, _, size = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset+size].rstrip(b"\0")
+            offset += size
+
+            if mask & IN_Q_OVERFLOW:
+                return None
+
+            directory = self.dirs.get(wd)
+            if directory is not None and name:
+                paths.add(os.path.join(directory, os.fsdecode(name)))
+
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher:
+    """
+    Makes the given rules, and makes them again whenever a file they depend
+    on changes. The rule graph, stat cache and file hashes are kept between
+    builds, and only the rules that depend on a changed file are checked
+    again, everything else is known to be up to date.
+    """
+
+    settle: float
+
+    def __init__(self, macher, rules: list[Rule], settle: float = 0.1):
+        self.macher = macher
+        self.rules = rules
+        self.settle = settle
+
+        self.inotify = Inotify()
+        self.parents: dict[Rule, list[Rule]] = {}
+        self.files: dict[str, Rule] = {}
+        self.implicit: dict[str, list[Rule]] = {}
+        self.globbed: dict[str, list[Rule]] = {}
+        self.sigs: dict[str, str | None] = {}
+
+    def _build(self):
+        for rule in self.rules:
+            try:
+                self.macher.mach(rule)
+            except Exception as ex:
+                # Keep watching, the next change may fix it.
+                self.macher._log(f"Failed to make {rule}: {ex}")
+                continue
+
+            # Everything needed for this rule is up to date now.
+            for r in self.macher.plan(rule):
+                r.mark_done()
+
+        self._index()
+
+    def _index(self):
+        """Learns which files to watch, and which rules depend on them"""
+        self.parents = {}
+        self.files = {}
+        self.implicit = {}
+        self.globbed = {}
+
+        for rule in self.rules:
+            for r in self.macher.plan(rule):
+                self.parents.setdefault(r, [])
+
+                for inp in self.macher.input_rules(r):
+                    self.parents.setdefault(inp, []).append(r)
+
+                for t in r.targets:
+                    if isinstance(t, File):
+                        path = os.path.normpath(os.path.abspath(t.name))
+                        self.files[path] = r
+                        self._watch(path)
+
+                # Inputs listed in a depfile, like headers, concern the rule that reads them.
+                for name in self.macher._depfile_deps(r) or []:
+                    path = os.path.normpath(os.path.abspath(name))
+                    self.implicit.setdefault(path, []).append(r)
+                    self._watch(path)
+
+                # Files added to or removed from the directories of a glob change the inputs.
+                for directory in self.macher._glob_dirs(r):
+                    watched = self._watch(os.path.join(os.path.abspath(directory), "."))
+                    self.globbed.setdefault(watched, []).append(r)
+
+        # What the files look like now, including what we just made.
+        self.sigs = { path: self._signature(path) for path in self.files.keys() | self.implicit.keys() }
+
+    def _watch(self, path: str) -> str:
+        """
+        Watches the directory of the given file. If it doesn't exist yet, e.g.
+        because the build that should create it failed, the nearest existing
+        parent is watched instead, the directory itself once a build made it.
+        Returns the directory that is watched.
+        """
+        directory = os.path.normpath(os.path.dirname(path))
+
+        while True:
+            try:
+                self.inotify.watch(directory)
+                return directory
+            except (FileNotFoundError, NotADirectoryError):
+                parent = os.path.dirname(directory)
+                if parent == directory:
+                    raise
+
+                directory = parent
+
+    def _signature(self, path: str) -> str | None:
+        self.macher.stats.invalidate(path)
+        return self.macher._signature(File(path))
+
+    def _changed(self, paths: set[str]) -> list[Rule]:
+        """
+        The rules for the files that really changed, ignoring our own writes,
+        and the rules whose globs match other files now.
+        """
+        changed = []
+        globbed: set[Rule] = set()
+
+        for path in paths:
+            rules = self.implicit.get(path, [])
+            if path in self.files:
+                rules = [ self.files[path], *rules ]
+
+            if not rules:
+                continue
+
+            sig = self._signature(path)
+            if sig != self.sigs.get(path):
+                self.sigs[path] = sig
+                changed.extend(rules)
+
+        for path in paths:
+            globbed.update( self.globbed.get(os.path.dirname(path), []) )
+
+        for rule in globbed:
+            if self.macher._expand_again(rule):
+                changed.append(rule)
+
+        return changed
+
+    def _reset(self, rules: list[Rule]):
+        """Forgets that the given rules and everything depending on them are up to date"""
+        stack = list(rules)
+        seen = set(stack)
+
+        while stack:
+            rule = stack.pop()
+
+            for t in rule.targets:
+                t.done = False
+
+            for p in self.parents.get(rule, []):
+                if p not in seen:
+                    seen.add(p)
+                    stack.append(p)
+
+    def _wait(self) -> list[Rule]:
+        """Waits for changes to the watched files, returns the rules for the files that changed"""
+        while True:
+            paths = self.inotify.read()
+            if paths is None:
+                # We lost track, check everything.
+                return list(self.files.values())
+
+            # Editors and checkouts touch many files at once, wait for them to settle.
+            deadline = time.monotonic() + self.settle
+            while ( left := deadline - time.monotonic() ) > 0:
+                more = self.inotify.read(left)
+                if more is None:
+                    return list(self.files.values())
+
+                paths |= more
+
+            changed = self._changed(paths)
+            if changed:
+                return changed
+
+    def run(self, stop: Callable[[], bool] = lambda: False):
+        try:
+            self._build()
+
+            while not stop():
+                self.macher._log("watching for changes...")
+                changed = self._wait()
+
+                self.macher._log("changed: " + ", ".join( str(r) for r in changed ))
+                self._reset(changed)
+                self._build()
+        finally:
+            self.inotify.close()
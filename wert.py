@@ -1,5 +1,7 @@
 import re
 
+from functools import lru_cache
+from types import CodeType
 from typing import Any, TypeAlias, Protocol, override
 from collections import ChainMap
 from collections.abc import Sequence
@@ -62,78 +64,140 @@ def flatten(x: Quotable, quote = False) -> str:
 _var_pattern = re.compile(r'\$\'?(.)')
 _name_pattern = re.compile(r'\w+')
 
-def _expand_next(s: str, ctx: Context) -> tuple[str, str]:
+class _Var:
+    """A variable reference like $< or $'@' in a template"""
+    __slots__ = ( "key", "quoted" )
 
-    match = _var_pattern.search(s)
+    def __init__(self, key: str, quoted: bool):
+        self.key = key
+        self.quoted = quoted
 
-    if match is None:
-        return ( s, "" )
+    def evaluate(self, ctx: Context) -> VarValue:
+        # TODO: warn/fail on missing variables
+        return ctx.get(self.key)
 
-    quoted = match.group(0).startswith("$'")
-    key = match.group(1)
-    prefix = s[:match.start()]
+class _Expr:
+    """A python expression like $(foo) or $'(foo)' in a template"""
+    __slots__ = ( "code", "quoted" )
 
-    if _name_pattern.fullmatch(key):
-        raise Exception("Ambiguous variable "  + key)
-    elif key == "(":
-        exp = s[match.end():]
+    def __init__(self, code: CodeType, quoted: bool):
+        self.code = code
+        self.quoted = quoted
 
-        # python expression in parentacies. Try to parse up to the first syntax error,
-        # then expect the closing parantecie at that location.
-        # No syntax error means missing closing parantecie.
-        try:
-            ast = compile(exp, '<mach>', 'eval')
-            raise Exception("Expression started with $( was never closed'")
-        except SyntaxError as err:
-            if err.offset is None:
-                raise err
+    def evaluate(self, ctx: Context) -> VarValue:
+        return eval(self.code, globals(), ctx) # FIXME: strip private stuff from global scope
 
-            # Trim to location of first syntax error, which should be ")".
-            # The result should be a valid expression.
-            exp = exp[:err.offset-1]
+def _parse_expression(s: str, start: int, quoted: bool) -> tuple[_Expr, int]:
+    """
+    Parses the python expression starting at the given offset, up to the closing
+    parenthesis. Returns the compiled expression and the offset after the closing
+    parenthesis.
+    """
+    exp = s[start:]
 
-        if len(exp.strip()) == 0:
-            raise Exception("Expression is empty")
+    # python expression in parentacies. Try to parse up to the first syntax error,
+    # then expect the closing parantecie at that location.
+    # No syntax error means missing closing parantecie.
+    try:
+        compile(exp, '<mach>', 'eval')
+        raise Exception("Expression started with $( was never closed'")
+    except SyntaxError as err:
+        if err.offset is None:
+            raise err
 
-        end = match.end()+len(exp)
-        closing = ")'" if quoted else ")"
+        # Trim to location of first syntax error, which should be ")".
+        # The result should be a valid expression.
+        exp = exp[:err.offset-1]
 
-        if s[ end : end+len(closing) ] != closing:
-            raise Exception("Expected closing " + closing)
+    if len(exp.strip()) == 0:
+        raise Exception("Expression is empty")
 
-        remainder = s[end+len(closing):]
+    end = start+len(exp)
+    closing = ")'" if quoted else ")"
 
-        ast = compile(exp, '<mach>', 'eval')
-        v = eval(ast, globals(), ctx) # FIXME: strip private stuff from global scope
+    if s[ end : end+len(closing) ] != closing:
+        raise Exception("Expected closing " + closing)
 
-    else:
-        end = match.end()
+    code = compile(exp, '<mach>', 'eval')
+    return ( _Expr(code, quoted), end+len(closing) )
 
-        if quoted:
-            if s[ end ] != "'":
-                raise Exception("Expected closing single quote")
-            end += 1
+def _parse_line(s: str, parts: list[str | _Var | _Expr]):
+    pos = 0
 
-        # TODO: warn/fail on missing variables
-        v = ctx.get(key)
-        remainder = s[end:]
+    while True:
+        match = _var_pattern.search(s, pos)
+
+        if match is None:
+            parts.append(s[pos:])
+            return
+
+        parts.append(s[pos:match.start()])
 
-    # TODO: resolve callables in nested lists
-    while callable(v):
-        v = v(ctx)
+        quoted = match.group(0).startswith("$'")
+        key = match.group(1)
 
-    result = flatten(v, quoted)
-    return ( prefix + result, remainder )
+        if _name_pattern.fullmatch(key):
+            raise Exception("Ambiguous variable "  + key)
+        elif key == "(":
+            part, pos = _parse_expression(s, match.end(), quoted)
+        else:
+            pos = match.end()
+
+            if quoted:
+                if s[ pos : pos+1 ] != "'":
+                    raise Exception("Expected closing single quote")
+                pos += 1
+
+            part = _Var(key, quoted)
+
+        parts.append(part)
 
 _line_pattern = re.compile(r'(.*?)([\r\n]+|$)')
 
-def expand_all(s: str, ctx: Context) -> str:
-    result = ""
+class Template:
+    """
+    A string with variables and python expressions to be expanded, parsed
+    and compiled once. Rendering it against a context is a single pass over
+    its parts.
+    """
+    parts: list[str | _Var | _Expr]
+
+    def __init__(self, s: str):
+        parts: list[str | _Var | _Expr] = []
 
-    for (remainder, eol) in _line_pattern.findall(s):
-        while len(remainder)>0:
-            (chunk, remainder) = _expand_next(remainder, ctx)
-            result += chunk
-        result += eol
+        for (line, eol) in _line_pattern.findall(s):
+            _parse_line(line, parts)
+            parts.append(eol)
 
-    return result
+        # Merge adjacent literal chunks and drop empty ones.
+        self.parts = []
+        for part in parts:
+            if isinstance(part, str) and self.parts and isinstance(self.parts[-1], str):
+                self.parts[-1] += part
+            elif part != "":
+                self.parts.append(part)
+
+    def render(self, ctx: Context) -> str:
+        chunks = []
+
+        for part in self.parts:
+            if isinstance(part, str):
+                chunks.append(part)
+                continue
+
+            v = part.evaluate(ctx)
+
+            # TODO: resolve callables in nested lists
+            while callable(v):
+                v = v(ctx)
+
+            chunks.append( flatten(v, part.quoted) )
+
+        return "".join(chunks)
+
+@lru_cache(maxsize=4096)
+def compile_template(s: str) -> Template:
+    return Template(s)
+
+def expand_all(s: str, ctx: Context) -> str:
+    return compile_template(s).render(ctx)